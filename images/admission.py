@@ -0,0 +1,103 @@
+"""
+Admission control for on-demand variant generation: a budget of concurrent
+generations per node, and a token bucket per client.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from images.authorization import is_valid
+from images.locks import try_slot
+from images.stats import BatchedCounter
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationBusy(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_buckets = OrderedDict()
+
+
+def _log_shed_counts(counts):
+    logger.warning(
+        "Shed on-demand generations: %s",
+        ", ".join(f"{count} {reason}" for reason, count in sorted(counts.items())),
+    )
+
+
+shed_counts = BatchedCounter(_log_shed_counts)
+
+
+def client_key(request):
+    # Image routes don't require a key, so an invalid one would let a client
+    # get a new bucket with every request
+    authorization = request.headers.get("Authorization")
+    if authorization and is_valid(authorization):
+        return f"key:{authorization}"
+
+    if settings.VARIANT_GENERATION_CLIENT_HEADER:
+        # Clients can send the header themselves, only the entries appended
+        # by the trusted proxies at the end of the list can be relied on
+        forwarded = request.headers.get(
+            settings.VARIANT_GENERATION_CLIENT_HEADER, ""
+        ).split(",")
+        if len(forwarded) >= settings.VARIANT_GENERATION_TRUSTED_PROXIES:
+            client = forwarded[-settings.VARIANT_GENERATION_TRUSTED_PROXIES].strip()
+            if client:
+                return "client:" + client
+
+    return "client:" + request.META.get("REMOTE_ADDR", "")
+
+
+def take_token(client):
+    """
+    Take a token from the bucket of a client. Returns 0 when one was taken,
+    or the number of seconds until the next one otherwise.
+    """
+    if not settings.VARIANT_GENERATION_RATE:
+        return 0
+
+    now = time.monotonic()
+
+    with _lock:
+        tokens, updated_at = _buckets.pop(
+            client, (settings.VARIANT_GENERATION_BURST, now)
+        )
+        tokens = min(
+            settings.VARIANT_GENERATION_BURST,
+            tokens + (now - updated_at) * settings.VARIANT_GENERATION_RATE,
+        )
+
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / settings.VARIANT_GENERATION_RATE
+
+        _buckets[client] = (tokens, now)
+        while len(_buckets) > settings.VARIANT_GENERATION_RATE_CLIENTS:
+            _buckets.popitem(last=False)
+
+    return wait
+
+
+@contextmanager
+def generation_slot():
+    """
+    Hold one of the VARIANT_GENERATION_SLOTS generation slots of this node
+    while there is one free. Yields whether a slot was free.
+    """
+    if not settings.VARIANT_GENERATION_SLOTS:
+        yield True
+        return
+
+    with try_slot("generation", settings.VARIANT_GENERATION_SLOTS) as acquired:
+        yield acquired
@@ -0,0 +1,65 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from images.models import AuthorizationKey
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+
+
+def _get_permissions(key):
+    """
+    Return the permission flags of an authorization key, or None when it
+    doesn't exist. Unknown keys are cached too, so that retrying with a wrong
+    key doesn't reach the database.
+    """
+    try:
+        key_id = uuid.UUID(key)
+    except ValueError:
+        return None
+
+    now = time.monotonic()
+
+    with _lock:
+        entry = _entries.get(key_id)
+        if entry is not None and entry[0] > now:
+            _entries.move_to_end(key_id)
+            return entry[1]
+
+    permissions = (
+        AuthorizationKey.objects.filter(id=key_id)
+        .values("can_upload_image", "can_upload_variant")
+        .first()
+    )
+
+    with _lock:
+        _entries[key_id] = (now + settings.AUTHORIZATION_CACHE_TTL, permissions)
+        _entries.move_to_end(key_id)
+
+        while len(_entries) > settings.AUTHORIZATION_CACHE_MAX_KEYS:
+            _entries.popitem(last=False)
+
+    return permissions
+
+
+def is_valid(key):
+    return _get_permissions(key) is not None
+
+
+def has_permission(key, permission):
+    """
+    Whether an authorization key exists and has a permission flag, such as
+    "can_upload_image", set.
+    """
+    permissions = _get_permissions(key)
+
+    return bool(permissions and permissions[permission])
+
+
+def invalidate(key_id):
+    with _lock:
+        _entries.pop(uuid.UUID(str(key_id)), None)
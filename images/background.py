@@ -0,0 +1,104 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_pending = set()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+
+    with _lock:
+        # Threads don't survive a fork, so a child builds its own pool
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.VARIANT_GENERATION_WORKERS,
+                thread_name_prefix="kakigoori-variants",
+            )
+            _executor_pid = os.getpid()
+            _pending.clear()
+
+        return _executor
+
+
+def _run(key, description, function, image_id, *args):
+    from images.models import Image
+
+    try:
+        function(Image.objects.get(id=image_id), *args)
+    except Exception:
+        logger.exception("Background %s of %s failed", description, image_id)
+    finally:
+        connection.close()
+
+        with _lock:
+            _pending.discard(key)
+
+
+def _submit(key, description, function, image_id, *args):
+    """
+    Queue a job, unless it is already queued or the queue is full. Returns
+    whether the job was queued.
+    """
+    executor = _get_executor()
+
+    with _lock:
+        if key in _pending or len(_pending) >= settings.VARIANT_GENERATION_QUEUE_SIZE:
+            return False
+
+        _pending.add(key)
+
+    executor.submit(_run, key, description, function, image_id, *args)
+
+    return True
+
+
+def _create_variant(image, width, height):
+    from images import admission
+
+    try:
+        image.create_variant(width, height)
+    except admission.GenerationBusy:
+        # The request was already redirected elsewhere, a later one queues
+        # the size again
+        admission.shed_counts.add("busy")
+
+
+def _create_eager_variants(image):
+    image.create_eager_variants()
+
+
+def create_variant(image, width, height):
+    """
+    Queue the generation of a variant. Returns whether it was queued.
+    """
+    return _submit(
+        (image.id, width, height),
+        f"generation at {width}x{height}",
+        _create_variant,
+        image.id,
+        width,
+        height,
+    )
+
+
+def create_eager_variants(image):
+    """
+    Queue the generation of the eager variants of an image. Returns whether
+    it was queued.
+    """
+    return _submit(
+        (image.id, "eager"),
+        "eager generation",
+        _create_eager_variants,
+        image.id,
+    )
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+_lock = threading.Lock()
+_local_entries = OrderedDict()
+
+
+def accept_class(request, image_type):
+    if image_type != "auto":
+        return ""
+
+    accept_header = request.headers.get("Accept", default="")
+
+    return "+".join(
+        file_type
+        for file_type in ["avif", "webp"]
+        if f"image/{file_type}" in accept_header
+    )
+
+
+def _shared_cache():
+    if settings.REDIRECT_CACHE_BACKEND is None:
+        return None
+
+    return caches[settings.REDIRECT_CACHE_BACKEND]
+
+
+def _version_key(image_id):
+    return f"kakigoori:redirect:{image_id}:version"
+
+
+def _entry_key(image_id, version, key):
+    return f"kakigoori:redirect:{image_id}:{version}:" + ":".join(map(str, key))
+
+
+def _get_local(image_id, key):
+    """
+    Return the (version, value) of a local entry, or None.
+    """
+    with _lock:
+        entries = _local_entries.get(image_id)
+        if entries is None:
+            return None
+
+        _local_entries.move_to_end(image_id)
+
+        entry = entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, version, value = entry
+        if expires_at < time.monotonic():
+            del entries[key]
+            return None
+
+        return version, value
+
+
+def _set_local(image_id, key, value, version=None):
+    expires_at = time.monotonic() + settings.REDIRECT_CACHE_TTL
+
+    with _lock:
+        entries = _local_entries.get(image_id)
+        if entries is None:
+            entries = _local_entries[image_id] = OrderedDict()
+        else:
+            _local_entries.move_to_end(image_id)
+
+        entries[key] = (expires_at, version, value)
+        entries.move_to_end(key)
+
+        # Entries are in expiry order, since they all live for the same time
+        now = time.monotonic()
+        while entries and (
+            next(iter(entries.values()))[0] < now
+            or len(entries) > settings.REDIRECT_CACHE_MAX_ENTRIES_PER_IMAGE
+        ):
+            entries.popitem(last=False)
+
+        while len(_local_entries) > settings.REDIRECT_CACHE_MAX_IMAGES:
+            _local_entries.popitem(last=False)
+
+
+def get(image_id, key):
+    shared_cache = _shared_cache()
+    if shared_cache is None:
+        local_entry = _get_local(image_id, key)
+        return None if local_entry is None else local_entry[1]
+
+    # Local entries are only used while the version they were read with is
+    # current, so that invalidations from other workers reach them
+    version = shared_cache.get(_version_key(image_id))
+    if version is None:
+        return None
+
+    local_entry = _get_local(image_id, key)
+    if local_entry is not None and local_entry[0] == version:
+        return local_entry[1]
+
+    value = shared_cache.get(_entry_key(image_id, version, key))
+    if value is not None:
+        _set_local(image_id, key, value, version)
+
+    return value
+
+
+def set(image_id, key, value):
+    shared_cache = _shared_cache()
+    if shared_cache is None:
+        _set_local(image_id, key, value)
+        return
+
+    # Versions are never reused, so entries written before an invalidation
+    # (or before the version key got evicted) can't be read back.
+    shared_cache.add(_version_key(image_id), time.time_ns(), timeout=None)
+    version = shared_cache.get(_version_key(image_id))
+    if version is not None:
+        shared_cache.set(_entry_key(image_id, version, key), value)
+        _set_local(image_id, key, value, version)
+
+
+def invalidate(image_id):
+    with _lock:
+        _local_entries.pop(image_id, None)
+
+    shared_cache = _shared_cache()
+    if shared_cache is not None:
+        shared_cache.set(_version_key(image_id), time.time_ns(), timeout=None)
@@ -1,9 +1,11 @@
+import math
 from functools import wraps
-from typing import Optional
 
 from django.http import JsonResponse, HttpResponseForbidden
 
-from images.models import Image, AuthorizationKey
+from images import authorization, cache as redirect_cache
+from images.models import Image, task_requests, variant_hits
+from images.utils import file_type_from_url, redirect_with_size, snap_to_ladder
 
 
 def get_image(func):
@@ -20,17 +22,63 @@ def get_image(func):
     return wrapper
 
 
+def cache_redirect(func):
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        image_type = kwargs["image_type"]
+        # Sizes snapping to the same rung share an entry. The full size of the
+        # image isn't known yet, but clamping to it after snapping gives the
+        # same result.
+        width, height = [
+            None if size is None else snap_to_ladder(size, math.inf)
+            for size in (kwargs.get("width"), kwargs.get("height"))
+        ]
+        key = (
+            func.__name__,
+            width,
+            height,
+            image_type,
+            redirect_cache.accept_class(request, image_type),
+        )
+
+        cached_redirect = redirect_cache.get(kwargs["image_id"], key)
+        if cached_redirect is not None:
+            url, width, height = cached_redirect
+            task_requests.add((kwargs["image_id"], int(width), int(height)))
+            variant_hits.add(
+                (kwargs["image_id"], int(width), int(height), file_type_from_url(url))
+            )
+
+            return redirect_with_size(url, width, height)
+
+        response = func(request, *args, **kwargs)
+
+        cacheable = "no-store" not in response.get("Cache-Control", "")
+        if response.status_code == 302 and cacheable:
+            redirect_cache.set(
+                kwargs["image_id"],
+                key,
+                (
+                    response.url,
+                    response["X-Image-Width"],
+                    response["X-Image-Height"],
+                ),
+            )
+
+        return response
+
+    return wrapper
+
+
 def can_upload_image(func):
     @wraps(func)
     def wrapper(request, *args, **kwargs):
         if "Authorization" not in request.headers:
             return HttpResponseForbidden()
 
-        authorization_key: Optional[AuthorizationKey] = AuthorizationKey.objects.filter(
-            id=request.headers["Authorization"], can_upload_image=True
-        ).first()
-
-        if not authorization_key:
+        if not authorization.has_permission(
+            request.headers["Authorization"], "can_upload_image"
+        ):
             return HttpResponseForbidden()
 
         return func(request, *args, **kwargs)
@@ -44,11 +92,9 @@ def can_upload_variant(func):
         if "Authorization" not in request.headers:
             return HttpResponseForbidden()
 
-        authorization_key: Optional[AuthorizationKey] = AuthorizationKey.objects.filter(
-            id=request.headers["Authorization"], can_upload_variant=True
-        ).first()
-
-        if not authorization_key:
+        if not authorization.has_permission(
+            request.headers["Authorization"], "can_upload_variant"
+        ):
             return HttpResponseForbidden()
 
         return func(request, *args, **kwargs)
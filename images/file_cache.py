@@ -0,0 +1,203 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from images.storage import get_storage
+
+_lock = threading.Lock()
+_estimated_size = None
+_scanned_at = None
+
+
+def _path(key):
+    _, extension = os.path.splitext(key)
+    return os.path.join(
+        settings.FILE_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest() + extension
+    )
+
+
+def _evict(added_size):
+    global _estimated_size, _scanned_at
+
+    with _lock:
+        if (
+            _estimated_size is not None
+            and time.monotonic() - _scanned_at < settings.FILE_CACHE_SCAN_INTERVAL
+        ):
+            _estimated_size += added_size
+            if _estimated_size <= settings.FILE_CACHE_MAX_BYTES:
+                return
+
+        _scanned_at = time.monotonic()
+
+    entries = []
+    total_size = 0
+    with os.scandir(settings.FILE_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    if total_size > settings.FILE_CACHE_MAX_BYTES:
+        # Evict least recently used files down to 90% of the budget, so that
+        # we don't scan the directory again on the very next write
+        target_size = settings.FILE_CACHE_MAX_BYTES * 0.9
+        for _, size, path in sorted(entries):
+            if total_size <= target_size:
+                break
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+            total_size -= size
+
+    with _lock:
+        _estimated_size = total_size
+
+
+class Writer:
+    """
+    Writes a local copy of an object as it is being received, such as while
+    it is uploaded to the bucket. commit() returns the copy opened for
+    reading, and keeps it in the cache when the cache is enabled.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+        if settings.FILE_CACHE_DIR is not None:
+            os.makedirs(settings.FILE_CACHE_DIR, exist_ok=True)
+
+        # Write to a hidden temporary file first so that readers never see a
+        # partial file
+        fd, self.temporary_path = tempfile.mkstemp(
+            dir=settings.FILE_CACHE_DIR, prefix="."
+        )
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        size = self.file.tell()
+        self.file.close()
+        try:
+            # Opened before eviction, which may pick this very file
+            file = open(self.temporary_path, "rb")
+            if settings.FILE_CACHE_DIR is None:
+                os.unlink(self.temporary_path)
+            else:
+                os.replace(self.temporary_path, _path(self.key))
+        except BaseException:
+            self.abort()
+            raise
+
+        if settings.FILE_CACHE_DIR is not None:
+            _evict(size)
+
+        return file
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.temporary_path)
+        except FileNotFoundError:
+            pass
+
+
+def _write(key, write):
+    writer = Writer(key)
+    try:
+        write(writer.file)
+    except BaseException:
+        writer.abort()
+        raise
+
+    return writer.commit()
+
+
+def store(key, fileobj):
+    """
+    Keep a copy of a file we just uploaded, when the cache is enabled.
+    """
+    if settings.FILE_CACHE_DIR is None:
+        return
+
+    position = fileobj.tell()
+    _write(key, lambda file: file.write(fileobj.read())).close()
+    fileobj.seek(position)
+
+
+@contextmanager
+def open_object(key):
+    """
+    Open a bucket object as a local file, downloading it into the cache on a
+    miss. Without a cache, the object is spooled to a temporary file.
+    """
+    if settings.FILE_CACHE_DIR is None:
+        with tempfile.TemporaryFile() as file:
+            get_storage().get(key, file)
+            file.seek(0)
+            yield file
+        return
+
+    path = _path(key)
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        file = _write(key, lambda file: get_storage().get(key, file))
+
+    with file:
+        # mtime is the LRU clock, atime is often disabled
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        yield file
+
+
+@contextmanager
+def object_path(key):
+    """
+    Like open_object, but yield a path that another process can open until the
+    context exits, even if the cache evicts the object meanwhile.
+    """
+    if settings.FILE_CACHE_DIR is None:
+        with tempfile.NamedTemporaryFile() as file:
+            get_storage().get(key, file)
+            file.flush()
+            yield file.name
+        return
+
+    with open_object(key) as file:
+        # A hidden hard link is skipped by eviction and costs no copy
+        fd, link_path = tempfile.mkstemp(dir=settings.FILE_CACHE_DIR, prefix=".")
+        os.close(fd)
+        os.unlink(link_path)
+        try:
+            os.link(_path(key), link_path)
+        except FileNotFoundError:
+            # Evicted since it was opened
+            with open(link_path, "wb") as link_file:
+                shutil.copyfileobj(file, link_file)
+
+        try:
+            yield link_path
+        finally:
+            os.unlink(link_path)
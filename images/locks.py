@@ -0,0 +1,75 @@
+import fcntl
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_guard = threading.Lock()
+_thread_locks = {}
+
+
+def _lock_file_path(name):
+    # Lock files are striped instead of created per name so the directory
+    # stays bounded; unrelated names sharing a stripe just wait a bit longer.
+    stripe = int(hashlib.md5(name.encode()).hexdigest(), 16) % settings.LOCK_STRIPES
+    return os.path.join(settings.LOCK_DIR, f"{stripe}.lock")
+
+
+@contextmanager
+def single_flight(name):
+    """
+    Hold an exclusive lock on `name` across the threads of this process and
+    every process of this node sharing settings.LOCK_DIR.
+    """
+    with _guard:
+        entry = _thread_locks.setdefault(name, [threading.Lock(), 0])
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            os.makedirs(settings.LOCK_DIR, exist_ok=True)
+            fd = os.open(_lock_file_path(name), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+    finally:
+        with _guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _thread_locks[name]
+
+
+@contextmanager
+def try_slot(name, count):
+    """
+    Try to hold one of `count` slots named `name`, shared by every process of
+    this node. Yields whether a slot was free, without waiting for one.
+    """
+    os.makedirs(settings.LOCK_DIR, exist_ok=True)
+
+    for index in range(count):
+        fd = os.open(
+            os.path.join(settings.LOCK_DIR, f"{name}-{index}.slot"),
+            os.O_RDWR | os.O_CREAT,
+            0o600,
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+        return
+
+    yield False
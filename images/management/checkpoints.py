@@ -0,0 +1,30 @@
+"""
+Resumable passes over the images, in id order, for management commands.
+"""
+
+import os
+
+
+def read_checkpoint(path):
+    """
+    Id of the last image done by a previous run, or None to start over.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return f.read().strip() or None
+
+
+def write_checkpoint(path, image_id):
+    with open(f"{path}.tmp", "w") as f:
+        f.write(str(image_id))
+
+    os.replace(f"{path}.tmp", path)
+
+
+def images_after(images, image_id):
+    if image_id is None:
+        return images
+
+    return images.filter(id__gt=image_id)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from images.models import Image
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Also rebuild catalogs that are already filled in",
+        )
+
+    def handle(self, *args, **options):
+        images = Image.objects.only("id")
+        if not options["all"]:
+            images = images.filter(variant_catalog=[])
+
+        images_len = images.count()
+        print(f"{images_len} images to backfill")
+
+        for index, image in enumerate(images.iterator(chunk_size=1000), start=1):
+            image.refresh_variant_catalog()
+
+            if index % 1000 == 0 or index == images_len:
+                print(f"Image {index}/{images_len}")
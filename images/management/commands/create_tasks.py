@@ -1,35 +1,105 @@
+import time
+from collections import defaultdict
+
 from django.core.management.base import BaseCommand
 
+from images.management.checkpoints import (
+    images_after,
+    read_checkpoint,
+    write_checkpoint,
+)
 from images.models import Image, ImageVariant, ImageVariantTask
 
 
 class Command(BaseCommand):
+    help = "Create the conversion tasks of every variant size missing a format"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--types", nargs="+", default=["avif", "webp", "jpegli"])
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--checkpoint",
+            help="File recording the last image done, to resume from on the next run",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Count the missing tasks without creating them",
+        )
+
+    def _missing_tasks(self, image_ids, file_types):
+        sizes = defaultdict(set)
+        for image_id, width, height, file_type in ImageVariant.objects.filter(
+            image_id__in=image_ids
+        ).values_list("image_id", "width", "height", "file_type"):
+            sizes[image_id, width, height].add(file_type)
+
+        for image_id, width, height, file_type in ImageVariantTask.objects.filter(
+            image_id__in=image_ids
+        ).values_list("image_id", "width", "height", "file_type"):
+            sizes[image_id, width, height].add(file_type)
+
+        tasks = []
+        for (image_id, width, height), size_file_types in sizes.items():
+            # Tasks are encoded from the jpg or png of their own size
+            original_file_types = size_file_types & {"jpg", "png"}
+            if not original_file_types:
+                continue
+
+            tasks += [
+                ImageVariantTask(
+                    image_id=image_id,
+                    width=width,
+                    height=height,
+                    original_file_type=min(original_file_types),
+                    file_type=file_type,
+                )
+                for file_type in file_types
+                if file_type not in size_file_types
+            ]
+
+        return tasks
+
     def handle(self, *args, **options):
-        images = Image.objects.filter(model_version=2).all()
-        images_len = len(images)
-        for index, image in enumerate(images):
-            print(f"Image {index}/{images_len}")
-            variants = ImageVariant.objects.filter(image=image).all()
-            variant_sizes = list(set(map(lambda x: (x.width, x.height), variants)))
-
-            for image_type in ["avif", "webp", "jpegli"]:
-                for variant_size in variant_sizes:
-                    avif_variant = [
-                        x
-                        for x in variants
-                        if x.width == variant_size[0]
-                        and x.height == variant_size[1]
-                        and x.file_type == image_type
-                    ]
-                    if not avif_variant:
-                        ImageVariantTask(
-                            image=image,
-                            height=variant_size[1],
-                            width=variant_size[0],
-                            original_file_type=image.imagevariant_set.filter(
-                                is_full_size=True, file_type__in=["jpg", "png"]
-                            )
-                            .first()
-                            .file_type,
-                            file_type=image_type,
-                        ).save()
+        images = Image.objects.filter(model_version=2).order_by("id")
+
+        last_image_id = read_checkpoint(options["checkpoint"])
+        if last_image_id is not None:
+            print(f"Resuming after image {last_image_id}")
+
+        images_len = images_after(images, last_image_id).count()
+        print(f"{images_len} images to check")
+
+        start = time.monotonic()
+        image_count = 0
+        task_count = 0
+        while True:
+            image_ids = list(
+                images_after(images, last_image_id).values_list("id", flat=True)[
+                    : options["chunk_size"]
+                ]
+            )
+            if not image_ids:
+                break
+
+            tasks = self._missing_tasks(image_ids, options["types"])
+            if not options["dry_run"]:
+                ImageVariantTask.objects.bulk_create(tasks, ignore_conflicts=True)
+
+                if options["checkpoint"]:
+                    write_checkpoint(options["checkpoint"], image_ids[-1])
+
+            last_image_id = image_ids[-1]
+            image_count += len(image_ids)
+            task_count += len(tasks)
+
+            elapsed = time.monotonic() - start
+            print(
+                f"Image {image_count}/{images_len}, {task_count} tasks, "
+                f"{image_count / elapsed:.0f} images/s"
+            )
+
+        if options["dry_run"]:
+            print(f"{task_count} tasks missing")
+        else:
+            print(f"{task_count} tasks created")
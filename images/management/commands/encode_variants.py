@@ -0,0 +1,229 @@
+import logging
+import multiprocessing
+import os
+import resource
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker(memory_limit):
+    django.setup()
+
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    # Shutdown is handled by the parent, which lets running tasks finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError()
+
+
+def _encode(source_path, upload_path, file_type, timeout):
+    from images import file_cache, processing
+    from images.storage import get_storage
+
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.alarm(timeout)
+    try:
+        with file_cache.open_object(source_path) as source:
+            data = processing.encode(
+                source, file_type, settings.ENCODER_QUALITY[file_type]
+            )
+
+        get_storage().put(upload_path, BytesIO(data))
+    finally:
+        signal.alarm(0)
+
+    return len(data)
+
+
+class Command(BaseCommand):
+    help = "Claim conversion tasks from the database and encode them locally"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--types", nargs="+", default=["avif", "webp", "jpegli"])
+        parser.add_argument("--processes", type=int, default=os.cpu_count())
+        parser.add_argument(
+            "--timeout", type=int, default=300, help="Seconds allowed per task"
+        )
+        parser.add_argument(
+            "--memory-limit",
+            type=int,
+            default=0,
+            help="Address space limit of each process, in MiB",
+        )
+        parser.add_argument(
+            "--report-interval",
+            type=int,
+            default=30,
+            help="Seconds between throughput reports",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once there are no tasks left instead of waiting for more",
+        )
+
+    def _make_executor(self, options):
+        return ProcessPoolExecutor(
+            max_workers=options["processes"],
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(options["memory_limit"] * 1024 * 1024,),
+        )
+
+    def _claim(self, file_types, count, options):
+        from images.models import Image, ImageVariantTask
+
+        tasks = []
+        for file_type in file_types:
+            if len(tasks) >= count:
+                break
+
+            tasks += ImageVariantTask.claim(
+                file_type,
+                count - len(tasks),
+                options["timeout"] + 60,
+                self.worker,
+            )
+
+        images = Image.objects.in_bulk([task.image_id for task in tasks])
+        for task in tasks:
+            task.image = images[task.image_id]
+
+        return tasks
+
+    def _log_last_attempt(self, task):
+        if task.attempts >= settings.TASK_MAX_ATTEMPTS:
+            logger.error(
+                "Task %s failed %d times, it won't be claimed again",
+                task.id,
+                task.attempts,
+            )
+
+    def _report(self, completed_count, failed_count, encoded_bytes, elapsed):
+        print(
+            f"{completed_count} tasks done, {failed_count} failed, "
+            f"{completed_count / elapsed:.2f} tasks/s, "
+            f"{encoded_bytes / elapsed / 1024:.0f} KiB/s"
+        )
+
+    def _stop(self, signum, frame):
+        if self.stopping.is_set():
+            raise KeyboardInterrupt()
+
+        print("Stopping once the running tasks are done...")
+        self.stopping.set()
+
+    def handle(self, *args, **options):
+        from images import processing
+        from images.models import ImageVariantTask
+
+        encoders = processing.available_encoders()
+        for file_type in options["types"]:
+            if file_type not in encoders:
+                print(f"No {file_type} encoder available, skipping {file_type} tasks")
+        file_types = [x for x in options["types"] if x in encoders]
+        if not file_types:
+            raise CommandError("None of the requested types can be encoded here")
+
+        self.worker = f"{socket.gethostname()}-{os.getpid()}"
+        self.stopping = threading.Event()
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+
+        executor = self._make_executor(options)
+        in_flight = {}
+        completed_count = failed_count = encoded_bytes = 0
+        report_start = time.monotonic()
+
+        try:
+            while in_flight or not self.stopping.is_set():
+                # Only claim what can start now, so that no lease runs out
+                # while its task waits for a process
+                free_slots = options["processes"] - len(in_flight)
+                if free_slots > 0 and not self.stopping.is_set():
+                    for task in self._claim(file_types, free_slots, options):
+                        future = executor.submit(
+                            _encode,
+                            task.source_path,
+                            task.upload_path,
+                            task.file_type,
+                            options["timeout"],
+                        )
+                        in_flight[future] = task
+
+                if not in_flight:
+                    if options["once"]:
+                        break
+
+                    self.stopping.wait(settings.TASK_POLL_INTERVAL)
+                    continue
+
+                done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+
+                completed_tasks = []
+                pool_broken = False
+                for future in done:
+                    task = in_flight.pop(future)
+                    try:
+                        encoded_bytes += future.result()
+                    except BrokenProcessPool:
+                        pool_broken = True
+                        failed_count += 1
+                        logger.error("Encoder process of task %s died", task.id)
+                        self._log_last_attempt(task)
+                    except Exception:
+                        failed_count += 1
+                        logger.exception("Task %s failed", task.id)
+                        self._log_last_attempt(task)
+                    else:
+                        completed_tasks.append(task)
+
+                # Failed tasks are left to their lease expiring, to be retried
+                # until they run out of attempts
+                if completed_tasks:
+                    ImageVariantTask.complete(completed_tasks)
+                    completed_count += len(completed_tasks)
+
+                if pool_broken:
+                    # One process exceeding its memory limit takes the whole
+                    # pool down, along with the tasks it was running
+                    for task in in_flight.values():
+                        failed_count += 1
+                        logger.error("Task %s lost with its process pool", task.id)
+                        self._log_last_attempt(task)
+                    in_flight = {}
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = self._make_executor(options)
+
+                elapsed = time.monotonic() - report_start
+                if elapsed >= options["report_interval"]:
+                    self._report(completed_count, failed_count, encoded_bytes, elapsed)
+                    completed_count = failed_count = encoded_bytes = 0
+                    report_start = time.monotonic()
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        executor.shutdown()
+        self._report(
+            completed_count,
+            failed_count,
+            encoded_bytes,
+            time.monotonic() - report_start,
+        )
@@ -0,0 +1,121 @@
+import operator
+import time
+from datetime import timedelta
+from functools import reduce
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from images import cache as redirect_cache
+from images.models import ImageVariant, ImageVariantTask
+from images.storage import get_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the sizes, other than full size, of which no variant was "
+        "requested for a while"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=90,
+            help="Evict sizes not requested for this many days",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Count the sizes to evict without deleting them",
+        )
+
+    def _evict(self, storage, sizes):
+        conditions = reduce(
+            operator.or_,
+            [
+                Q(image_id=image_id, width=width, height=height)
+                for image_id, width, height in sizes
+            ],
+        )
+        variants = list(
+            ImageVariant.objects.filter(conditions, is_full_size=False).select_related(
+                "image"
+            )
+        )
+
+        # Files go first: the variants of files that couldn't be deleted stay
+        # recorded, and the next run tries again
+        failed_keys = set(storage.delete([variant.file_path for variant in variants]))
+        variants = [
+            variant for variant in variants if variant.file_path not in failed_keys
+        ]
+        if not variants:
+            return 0, len(failed_keys)
+
+        images = {variant.image_id: variant.image for variant in variants}
+        with transaction.atomic():
+            ImageVariant.objects.filter(
+                id__in=[variant.id for variant in variants]
+            ).delete()
+            ImageVariantTask.objects.filter(conditions).delete()
+
+            for image in images.values():
+                image.refresh_variant_catalog()
+
+        for image_id in images:
+            redirect_cache.invalidate(image_id)
+
+        return len(variants), len(failed_keys)
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        cutoff = timezone.now() - timedelta(days=options["days"])
+
+        # A size is only evicted when none of its formats was requested
+        cold_sizes = (
+            ImageVariant.objects.filter(is_full_size=False)
+            .values("image_id", "width", "height")
+            .annotate(last_accessed=Max("last_accessed"))
+            .filter(last_accessed__lt=cutoff)
+            .order_by("image_id", "width", "height")
+            .values_list("image_id", "width", "height")
+        )
+
+        if options["dry_run"]:
+            print(f"{cold_sizes.count()} sizes not requested since {cutoff}")
+            return
+
+        start = time.monotonic()
+        size_count = 0
+        variant_count = 0
+        failed_count = 0
+        remaining_sizes = cold_sizes
+        # Sizes whose files couldn't be deleted stay cold, so each batch
+        # starts after the previous one rather than over
+        while batch := list(remaining_sizes[: options["batch_size"]]):
+            evicted, failed = self._evict(storage, batch)
+            variant_count += evicted
+            failed_count += failed
+            size_count += len(batch)
+
+            image_id, width, height = batch[-1]
+            remaining_sizes = cold_sizes.filter(
+                Q(image_id__gt=image_id)
+                | Q(image_id=image_id, width__gt=width)
+                | Q(image_id=image_id, width=width, height__gt=height)
+            )
+
+            elapsed = time.monotonic() - start
+            print(
+                f"{size_count} sizes, {variant_count} variants evicted, "
+                f"{failed_count} failed, {size_count / elapsed:.0f} sizes/s"
+            )
+
+        print(
+            f"{size_count} sizes, {variant_count} variants evicted, "
+            f"{failed_count} failed"
+        )
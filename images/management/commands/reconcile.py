@@ -0,0 +1,274 @@
+import re
+import time
+import uuid
+from collections import defaultdict
+from itertools import groupby
+
+from django.core.management.base import BaseCommand, CommandError
+
+from images import cache as redirect_cache
+from images.models import Image, ImageVariant, ImageVariantTask
+from images.storage import get_storage
+from images.utils import variant_file_name
+
+IMAGE_KEY_RE = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/(?P<image>[0-9a-f]{32})/")
+
+VARIANT_KEY_RE = re.compile(
+    IMAGE_KEY_RE.pattern
+    + r"(?P<width>\d+)-(?P<height>\d+)/(?:(?P<jpegli>jpegli\.jpg)|image\.(?P<file_type>[a-z]+))$"
+)
+
+
+def parse_variant_key(key):
+    """
+    Return the (image id hex, width, height, file type) of a variant key, or
+    None for keys outside of the per-size layout.
+    """
+    match = VARIANT_KEY_RE.match(key)
+    if match is None:
+        return None
+
+    return (
+        match["image"],
+        int(match["width"]),
+        int(match["height"]),
+        "jpegli" if match["jpegli"] else match["file_type"],
+    )
+
+
+def variant_key(image, width, height, file_type):
+    return f"{image.backblaze_filepath}/{width}-{height}/{variant_file_name(file_type)}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the stored variant files with the database, and report files "
+        "without a variant and variants without a file"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--prefix",
+            default="",
+            help="Only check the images whose folders start with this prefix, "
+            "such as 3d/ or 3d/b2/",
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--delete-orphans",
+            action="store_true",
+            help="Delete the files that have no variant",
+        )
+        parser.add_argument(
+            "--fix-missing",
+            action="store_true",
+            help="Delete the variants that have no file, and create conversion "
+            "tasks for the missing formats that can be encoded again",
+        )
+
+    def _stored_images(self, storage, prefix):
+        """
+        Yield the (image id hex, keys) of every image with files, in key
+        order, which is also image id order.
+        """
+        # Keys outside of image folders would break the ordering
+        matches = filter(None, map(IMAGE_KEY_RE.match, storage.list(prefix)))
+
+        for image_hex, image_matches in groupby(
+            matches, key=lambda match: match["image"]
+        ):
+            yield image_hex, [match.string for match in image_matches]
+
+    def _database_images(self, prefix, chunk_size):
+        """
+        Yield the (image id hex, image, variants) of every image, in id order,
+        loading chunk_size images and their variants at a time.
+        """
+        images = Image.objects.order_by("id")
+        id_prefix = prefix.replace("/", "")
+        if id_prefix:
+            images = images.filter(
+                id__gte=uuid.UUID(id_prefix.ljust(32, "0")),
+                id__lte=uuid.UUID(id_prefix.ljust(32, "f")),
+            )
+
+        last_image_id = None
+        while True:
+            chunk = (
+                images if last_image_id is None else images.filter(id__gt=last_image_id)
+            )
+            chunk = list(
+                chunk.only("id", "model_version", "width", "height")[:chunk_size]
+            )
+            if not chunk:
+                return
+
+            variants = defaultdict(set)
+            for image_id, width, height, file_type in ImageVariant.objects.filter(
+                image__in=chunk
+            ).values_list("image_id", "width", "height", "file_type"):
+                variants[image_id].add((width, height, file_type))
+
+            for image in chunk:
+                yield image.id.hex, image, variants[image.id]
+
+            last_image_id = chunk[-1].id
+
+    def _merge(self, stored_images, database_images):
+        """
+        Merge-join both sorted streams, yielding (image id hex, image or None,
+        variants, keys) for every image found on either side.
+        """
+        stored = next(stored_images, None)
+        database = next(database_images, None)
+
+        while stored is not None or database is not None:
+            if database is None or (stored is not None and stored[0] < database[0]):
+                yield stored[0], None, set(), stored[1]
+                stored = next(stored_images, None)
+            elif stored is None or database[0] < stored[0]:
+                yield database[0], database[1], database[2], []
+                database = next(database_images, None)
+            else:
+                yield database[0], database[1], database[2], stored[1]
+                stored = next(stored_images, None)
+                database = next(database_images, None)
+
+    def _flush_orphans(self, storage):
+        orphan_keys = self.orphan_keys
+        self.orphan_keys = []
+
+        # Files are stored before their variant is recorded, so skip the ones
+        # that got a variant since they were listed
+        parsed_keys = {key: parse_variant_key(key) for key in orphan_keys}
+        recorded = set(
+            (image_id.hex, width, height, file_type)
+            for image_id, width, height, file_type in ImageVariant.objects.filter(
+                image_id__in={parsed[0] for parsed in parsed_keys.values() if parsed}
+            ).values_list("image_id", "width", "height", "file_type")
+        )
+
+        keys = [key for key, parsed in parsed_keys.items() if parsed not in recorded]
+        failed_keys = storage.delete(keys)
+        for key in failed_keys:
+            print(f"Deleting {key} failed")
+        self.deleted_count += len(keys) - len(failed_keys)
+
+    def _fix_missing(self, storage, image, missing_variants, stored_variants):
+        # Nothing can replace a lost original. Variants are recorded after
+        # their file is stored, so one recorded since the listing started may
+        # have a file the listing missed.
+        missing_variants = [
+            (width, height, file_type)
+            for width, height, file_type in missing_variants
+            if (
+                (width, height) != (image.width, image.height)
+                or file_type not in ("jpg", "png")
+            )
+            and not storage.exists(variant_key(image, width, height, file_type))
+        ]
+        if not missing_variants:
+            return
+
+        for width, height, file_type in missing_variants:
+            ImageVariant.objects.filter(
+                image=image, width=width, height=height, file_type=file_type
+            ).delete()
+
+        tasks = []
+        for width, height, file_type in missing_variants:
+            original_file_types = {
+                stored_file_type
+                for stored_width, stored_height, stored_file_type in stored_variants
+                if (stored_width, stored_height) == (width, height)
+                and stored_file_type in ("jpg", "png")
+            }
+            if file_type in ("avif", "webp", "jpegli") and original_file_types:
+                tasks.append(
+                    ImageVariantTask(
+                        image=image,
+                        width=width,
+                        height=height,
+                        original_file_type=min(original_file_types),
+                        file_type=file_type,
+                    )
+                )
+
+        ImageVariantTask.objects.bulk_create(tasks, ignore_conflicts=True)
+        self.task_count += len(tasks)
+
+        image.refresh_variant_catalog()
+        redirect_cache.invalidate(image.id)
+
+    def handle(self, *args, **options):
+        if not re.fullmatch(r"([0-9a-f]{2}/){0,2}", options["prefix"]):
+            raise CommandError("The prefix should be made of up to two xx/ folders")
+
+        storage = get_storage()
+
+        self.orphan_keys = []
+        self.deleted_count = 0
+        self.task_count = 0
+
+        start = time.monotonic()
+        image_count = 0
+        key_count = 0
+        missing_count = 0
+        orphan_count = 0
+        for _, image, variants, keys in self._merge(
+            self._stored_images(storage, options["prefix"]),
+            self._database_images(options["prefix"], options["chunk_size"]),
+        ):
+            image_count += 1
+            key_count += len(keys)
+
+            if image is not None and image.model_version < 2:
+                # Not in the per-size layout yet
+                continue
+
+            parsed_keys = [(key, parse_variant_key(key)) for key in keys]
+            stored_variants = {parsed[1:] for _, parsed in parsed_keys if parsed}
+
+            orphan_keys = [
+                key
+                for key, parsed in parsed_keys
+                if parsed and parsed[1:] not in variants
+            ]
+            for key in orphan_keys:
+                print(f"Orphan {key}")
+            orphan_count += len(orphan_keys)
+
+            missing_variants = [
+                variant for variant in variants if variant not in stored_variants
+            ]
+            for variant in missing_variants:
+                print(f"Missing {variant_key(image, *variant)}")
+            missing_count += len(missing_variants)
+
+            if options["delete_orphans"] and orphan_keys:
+                self.orphan_keys += orphan_keys
+                if len(self.orphan_keys) >= options["chunk_size"]:
+                    self._flush_orphans(storage)
+
+            if options["fix_missing"] and missing_variants:
+                self._fix_missing(storage, image, missing_variants, stored_variants)
+
+            if image_count % options["chunk_size"] == 0:
+                elapsed = time.monotonic() - start
+                print(
+                    f"{image_count} images, {key_count} keys, "
+                    f"{missing_count} missing, {orphan_count} orphans, "
+                    f"{key_count / elapsed:.0f} keys/s"
+                )
+
+        if self.orphan_keys:
+            self._flush_orphans(storage)
+
+        print(
+            f"{image_count} images, {key_count} keys checked: "
+            f"{missing_count} missing, {orphan_count} orphans"
+        )
+        if options["delete_orphans"]:
+            print(f"{self.deleted_count} orphans deleted")
+        if options["fix_missing"]:
+            print(f"{self.task_count} conversion tasks created")
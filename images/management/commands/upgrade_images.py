@@ -1,215 +1,226 @@
-import sys
+import json
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image as PILImage
-
 
-import boto3
-from botocore.config import Config
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from PIL import Image as PILImage
 
+from images import cache as redirect_cache
+from images.management.checkpoints import (
+    images_after,
+    read_checkpoint,
+    write_checkpoint,
+)
 from images.models import Image, ImageVariant
-
-
-class Command(BaseCommand):
-    def get_b2_resource(self, endpoint, key_id, application_key):
-        b2 = boto3.resource(
-            service_name="s3",
-            endpoint_url=endpoint,
-            aws_access_key_id=key_id,
-            aws_secret_access_key=application_key,
-            config=Config(signature_version="s3v4"),
+from images.storage import get_storage
+
+
+def upgrade_version_1(image, storage):
+    """
+    Version 1 images have fixed file names for their original and thumbnail,
+    version 2 ones have a folder per size. Returns the (source key, key,
+    (width, height, file type)) copies to make and the keys to delete after.
+    """
+    if not image.width or not image.height:
+        original_image = BytesIO()
+        storage.get(f"{image.backblaze_filepath}/original.jpg", original_image)
+        original_image.seek(0)
+
+        with PILImage.open(original_image) as im:
+            image.width, image.height = im.size
+
+    full_size = (image.width, image.height)
+    thumbnail_size = image.thumbnail_size
+
+    file_names = [("original.jpg", "thumbnail.jpg", "image.jpg", "jpg")]
+    if image.is_jpegli_available:
+        file_names.append(
+            ("jpegli.jpg", "thumbnail_jpegli.jpg", "jpegli.jpg", "jpegli")
         )
+    if image.is_avif_available:
+        file_names.append(("optimized.avif", "thumbnail.avif", "image.avif", "avif"))
+    if image.is_webp_available:
+        file_names.append(("optimized.webp", "thumbnail.webp", "image.webp", "webp"))
+
+    copies = []
+    delete_keys = []
+    for full_size_name, thumbnail_name, file_name, file_type in file_names:
+        for old_name, (width, height) in [
+            (full_size_name, full_size),
+            (thumbnail_name, thumbnail_size),
+        ]:
+            copies.append(
+                (
+                    f"{image.backblaze_filepath}/{old_name}",
+                    f"{image.backblaze_filepath}/{width}-{height}/{file_name}",
+                    (width, height, file_type),
+                )
+            )
 
-        bucket = b2.Bucket("kakigoori")
+        # The original stays where it is
+        delete_keys.append(f"{image.backblaze_filepath}/{thumbnail_name}")
+        if file_type != "jpg":
+            delete_keys.append(f"{image.backblaze_filepath}/{full_size_name}")
 
-        return bucket
+    return copies, delete_keys
 
-    def handle(self, *args, **options):
-        images = Image.objects.filter(model_version=1).order_by("-creation_date").all()
-        images_len = len(images)
-        progress = 1
-        print(f"{images_len} images found")
-        for image in images:
-            print(f"Image {progress}/{images_len}")
-            try:
-                print("Upgrading image %s" % image.id)
 
-                bucket = self.get_b2_resource(
-                    "https://s3.eu-central-003.backblazeb2.com",
-                    "0032dcec6092f3e0000000021",
-                    "K0039Xb1GE/An9P1ccK2B+19pXrKnnU",
-                )
+UPGRADES = {1: upgrade_version_1}
 
-                print("Getting original image...")
 
-                original_image = BytesIO()
-                bucket.download_fileobj(
-                    f"{image.backblaze_filepath}/original.jpg", original_image
-                )
-                original_image.seek(0)
-
-                with PILImage.open(original_image) as im:
-                    image.height = im.height
-                    image.width = im.width
-                    image.save()
+class Command(BaseCommand):
+    help = "Move the files of images to the storage layout of the next model version"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from-version", type=int, default=1)
+        parser.add_argument("--workers", type=int, default=16)
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--checkpoint",
+            help="File recording the last image done, to resume from on the next run",
+        )
+        parser.add_argument(
+            "--failures", help="File to append the failed images to, as JSON lines"
+        )
 
-                print("Copying original images...")
+    def _fail(self, image, stage, error):
+        self.failure_count += 1
+        print(f"Image {image.id} failed while {stage}: {error!r}")
 
-                bucket.copy(
-                    {
-                        "Bucket": "kakigoori",
-                        "Key": f"{image.backblaze_filepath}/original.jpg",
-                    },
-                    f"{image.backblaze_filepath}/{image.width}-{image.height}/image.jpg",
-                )
-                bucket.copy(
-                    {
-                        "Bucket": "kakigoori",
-                        "Key": f"{image.backblaze_filepath}/thumbnail.jpg",
-                    },
-                    f"{image.backblaze_filepath}/{image.thumbnail_size[0]}-{image.thumbnail_size[1]}/image.jpg",
-                )
+        if self.failures_path:
+            failure = {"image_id": str(image.id), "stage": stage, "error": repr(error)}
+            with open(self.failures_path, "a") as f:
+                f.write(json.dumps(failure) + "\n")
 
-                delete_objects_list = [f"{image.backblaze_filepath}/thumbnail.jpg"]
-
-                ImageVariant(
-                    image=image,
-                    height=image.height,
-                    width=image.width,
-                    is_full_size=True,
-                    file_type="jpg",
-                ).save()
-                ImageVariant(
-                    image=image,
-                    height=image.thumbnail_size[1],
-                    width=image.thumbnail_size[0],
-                    is_full_size=False,
-                    file_type="jpg",
-                ).save()
-
-                if image.is_jpegli_available:
-                    print("Copying JPEGLI images...")
-                    bucket.copy(
-                        {
-                            "Bucket": "kakigoori",
-                            "Key": f"{image.backblaze_filepath}/jpegli.jpg",
-                        },
-                        f"{image.backblaze_filepath}/{image.width}-{image.height}/jpegli.jpg",
-                    )
-                    bucket.copy(
-                        {
-                            "Bucket": "kakigoori",
-                            "Key": f"{image.backblaze_filepath}/thumbnail_jpegli.jpg",
-                        },
-                        f"{image.backblaze_filepath}/{image.thumbnail_size[0]}-{image.thumbnail_size[1]}/jpegli.jpg",
-                    )
+    def _upgrade_batch(self, executor, images, upgrade, storage):
+        plan_futures = {
+            image: executor.submit(upgrade, image, storage) for image in images
+        }
 
+        plans = {}
+        for image, future in plan_futures.items():
+            try:
+                plans[image] = future.result()
+            except Exception as e:
+                self._fail(image, "planning", e)
+
+        copy_futures = [
+            (image, executor.submit(storage.copy, source_key, key))
+            for image, (copies, _) in plans.items()
+            for source_key, key, _ in copies
+        ]
+        for image, future in copy_futures:
+            try:
+                future.result()
+            except Exception as e:
+                if image in plans:
+                    del plans[image]
+                    self._fail(image, "copying", e)
+
+        if not plans:
+            return 0, 0
+
+        with transaction.atomic():
+            ImageVariant.objects.bulk_create(
+                [
                     ImageVariant(
                         image=image,
-                        height=image.height,
-                        width=image.width,
-                        is_full_size=True,
-                        file_type="jpegli",
-                    ).save()
-                    ImageVariant(
-                        image=image,
-                        height=image.thumbnail_size[0],
-                        width=image.thumbnail_size[1],
-                        is_full_size=False,
-                        file_type="jpegli",
-                    ).save()
-
-                    delete_objects_list += [
-                        f"{image.backblaze_filepath}/jpegli.jpg",
-                        f"{image.backblaze_filepath}/thumbnail_jpegli.jpg",
-                    ]
-                if image.is_avif_available:
-                    print("Copying AVIF images...")
-                    bucket.copy(
-                        {
-                            "Bucket": "kakigoori",
-                            "Key": f"{image.backblaze_filepath}/optimized.avif",
-                        },
-                        f"{image.backblaze_filepath}/{image.width}-{image.height}/image.avif",
-                    )
-                    bucket.copy(
-                        {
-                            "Bucket": "kakigoori",
-                            "Key": f"{image.backblaze_filepath}/thumbnail.avif",
-                        },
-                        f"{image.backblaze_filepath}/{image.thumbnail_size[0]}-{image.thumbnail_size[1]}/image.avif",
+                        width=width,
+                        height=height,
+                        file_type=file_type,
+                        is_full_size=(width, height) == (image.width, image.height),
+                        generation=(
+                            0 if (width, height) == (image.width, image.height) else 1
+                        ),
                     )
+                    for image, (copies, _) in plans.items()
+                    for _, _, (width, height, file_type) in copies
+                ],
+                ignore_conflicts=True,
+            )
+
+            catalogs = defaultdict(list)
+            for variant in (
+                ImageVariant.objects.filter(image__in=plans)
+                .order_by("width", "height", "file_type")
+                .values_list("image_id", "width", "height", "file_type")
+            ):
+                catalogs[variant[0]].append(list(variant[1:]))
+
+            for image in plans:
+                image.variant_catalog = catalogs[image.id]
+                image.model_version = self.from_version + 1
+
+            Image.objects.bulk_update(
+                plans, ["width", "height", "variant_catalog", "model_version"]
+            )
+
+        for image in plans:
+            redirect_cache.invalidate(image.id)
+
+        try:
+            failed_keys = storage.delete(
+                [key for _, delete_keys in plans.values() for key in delete_keys]
+            )
+            if failed_keys:
+                print(f"Deleting {len(failed_keys)} old files failed")
+        except Exception as e:
+            # The images are upgraded, only some old files are left behind
+            print(f"Deleting old files failed: {e!r}")
+
+        return len(plans), sum(len(copies) for copies, _ in plans.values())
 
-                    ImageVariant(
-                        image=image,
-                        height=image.height,
-                        width=image.width,
-                        is_full_size=True,
-                        file_type="avif",
-                    ).save()
-                    ImageVariant(
-                        image=image,
-                        height=image.thumbnail_size[0],
-                        width=image.thumbnail_size[1],
-                        is_full_size=False,
-                        file_type="avif",
-                    ).save()
-
-                    delete_objects_list += [
-                        f"{image.backblaze_filepath}/optimized.avif",
-                        f"{image.backblaze_filepath}/thumbnail.avif",
-                    ]
-                if image.is_webp_available:
-                    print("Copying WebP images...")
-                    bucket.copy(
-                        {
-                            "Bucket": "kakigoori",
-                            "Key": f"{image.backblaze_filepath}/optimized.webp",
-                        },
-                        f"{image.backblaze_filepath}/{image.width}-{image.height}/image.webp",
-                    )
-                    bucket.copy(
-                        {
-                            "Bucket": "kakigoori",
-                            "Key": f"{image.backblaze_filepath}/thumbnail.webp",
-                        },
-                        f"{image.backblaze_filepath}/{image.thumbnail_size[0]}-{image.thumbnail_size[1]}/image.webp",
-                    )
+    def handle(self, *args, **options):
+        self.from_version = options["from_version"]
+        upgrade = UPGRADES.get(self.from_version)
+        if upgrade is None:
+            raise CommandError(f"No upgrade from version {self.from_version}")
 
-                    ImageVariant(
-                        image=image,
-                        height=image.height,
-                        width=image.width,
-                        is_full_size=True,
-                        file_type="webp",
-                    ).save()
-                    ImageVariant(
-                        image=image,
-                        height=image.thumbnail_size[0],
-                        width=image.thumbnail_size[1],
-                        is_full_size=False,
-                        file_type="webp",
-                    ).save()
+        images = Image.objects.filter(model_version=self.from_version).order_by("id")
 
-                    delete_objects_list += [
-                        f"{image.backblaze_filepath}/optimized.webp",
-                        f"{image.backblaze_filepath}/thumbnail.webp",
-                    ]
+        last_image_id = read_checkpoint(options["checkpoint"])
+        if last_image_id is not None:
+            print(f"Resuming after image {last_image_id}")
 
-                print("Saving...")
+        images_len = images_after(images, last_image_id).count()
+        print(f"{images_len} images found")
+
+        storage = get_storage()
+        self.failures_path = options["failures"]
+        self.failure_count = 0
+
+        start = time.monotonic()
+        image_count = 0
+        upgraded_count = 0
+        copy_count = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            while True:
+                batch = list(
+                    images_after(images, last_image_id)[: options["batch_size"]]
+                )
+                if not batch:
+                    break
+
+                upgraded, copied = self._upgrade_batch(
+                    executor, batch, upgrade, storage
+                )
 
-                image.model_version = 2
-                image.save()
+                last_image_id = batch[-1].id
+                if options["checkpoint"]:
+                    write_checkpoint(options["checkpoint"], last_image_id)
 
-                print("Deleting old files...")
+                image_count += len(batch)
+                upgraded_count += upgraded
+                copy_count += copied
 
-                bucket.delete_objects(
-                    Delete={"Objects": [{"Key": x} for x in delete_objects_list]}
+                elapsed = time.monotonic() - start
+                print(
+                    f"Image {image_count}/{images_len}, {self.failure_count} failed, "
+                    f"{image_count / elapsed:.1f} images/s, "
+                    f"{copy_count / elapsed:.1f} copies/s"
                 )
 
-                progress += 1
-            except KeyboardInterrupt:
-                sys.exit(1)
-            except:
-                progress += 1
-                pass
+        print(f"{upgraded_count} images upgraded, {self.failure_count} failed")
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:40
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_variants(apps, schema_editor):
+    ImageVariant = apps.get_model("images", "ImageVariant")
+
+    duplicates = (
+        ImageVariant.objects.values("image", "width", "height", "file_type")
+        .annotate(min_id=Min("id"), count=Count("id"))
+        .filter(count__gt=1)
+    )
+
+    for duplicate in duplicates.iterator():
+        ImageVariant.objects.filter(
+            image=duplicate["image"],
+            width=duplicate["width"],
+            height=duplicate["height"],
+            file_type=duplicate["file_type"],
+        ).exclude(id=duplicate["min_id"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    replaces = [
+        ("images", "0007_image_variant_catalog"),
+        ("images", "0008_unique_image_variant"),
+    ]
+
+    dependencies = [
+        ("images", "0006_imagevarianttask"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="variant_catalog",
+            field=models.JSONField(default=list),
+        ),
+        migrations.RunPython(remove_duplicate_variants, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="imagevariant",
+            constraint=models.UniqueConstraint(
+                fields=("image", "width", "height", "file_type"),
+                name="unique_image_variant",
+            ),
+        ),
+    ]
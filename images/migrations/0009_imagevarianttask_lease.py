@@ -0,0 +1,30 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0007_image_variant_catalog_squashed_0008_unique_image_variant"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevarianttask",
+            name="leased_by",
+            field=models.CharField(blank=True, max_length=150),
+        ),
+        migrations.AddField(
+            model_name="imagevarianttask",
+            name="leased_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="imagevarianttask",
+            index=models.Index(
+                fields=["file_type", "leased_until"],
+                name="images_imag_file_ty_836ae5_idx",
+            ),
+        ),
+    ]
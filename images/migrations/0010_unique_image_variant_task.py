@@ -0,0 +1,44 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:09
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def remove_duplicate_tasks(apps, schema_editor):
+    ImageVariantTask = apps.get_model("images", "ImageVariantTask")
+
+    duplicates = (
+        ImageVariantTask.objects.values("image", "width", "height", "file_type")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+    )
+
+    for duplicate in duplicates.iterator():
+        tasks = ImageVariantTask.objects.filter(
+            image=duplicate["image"],
+            width=duplicate["width"],
+            height=duplicate["height"],
+            file_type=duplicate["file_type"],
+        ).order_by("created_at", "id")
+
+        ImageVariantTask.objects.filter(
+            id__in=list(tasks.values_list("id", flat=True)[1:])
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0009_imagevarianttask_lease"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_tasks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="imagevarianttask",
+            constraint=models.UniqueConstraint(
+                fields=("image", "width", "height", "file_type"),
+                name="unique_image_variant_task",
+            ),
+        ),
+    ]
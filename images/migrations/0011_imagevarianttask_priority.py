@@ -0,0 +1,43 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:09
+
+import images.models
+from django.db import migrations, models
+
+
+def set_initial_priorities(apps, schema_editor):
+    ImageVariantTask = apps.get_model("images", "ImageVariantTask")
+
+    tasks = []
+    for task in ImageVariantTask.objects.only("id", "created_at").iterator(
+        chunk_size=1000
+    ):
+        task.priority = images.models.initial_task_priority(task.created_at)
+        tasks.append(task)
+
+        if len(tasks) == 1000:
+            ImageVariantTask.objects.bulk_update(tasks, ["priority"])
+            tasks = []
+
+    ImageVariantTask.objects.bulk_update(tasks, ["priority"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0010_unique_image_variant_task"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevarianttask",
+            name="priority",
+            field=models.FloatField(default=images.models.initial_task_priority),
+        ),
+        migrations.RunPython(set_initial_priorities, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="imagevarianttask",
+            index=models.Index(
+                fields=["file_type", "-priority"], name="images_imag_file_ty_8b9da1_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:17
+
+from django.db import migrations, models
+
+
+def set_original_generations(apps, schema_editor):
+    ImageVariant = apps.get_model("images", "ImageVariant")
+    ImageVariant.objects.filter(is_full_size=True).update(generation=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0011_imagevarianttask_priority"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevariant",
+            name="generation",
+            field=models.IntegerField(default=1),
+        ),
+        migrations.RunPython(set_original_generations, migrations.RunPython.noop),
+    ]
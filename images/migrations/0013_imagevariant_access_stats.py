@@ -0,0 +1,24 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:23
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0012_imagevariant_generation"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevariant",
+            name="hits",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="imagevariant",
+            name="last_accessed",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0013_imagevariant_access_stats"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevarianttask",
+            name="attempts",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0014_imagevarianttask_attempts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevarianttask",
+            name="lease_token",
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,11 +1,24 @@
+import operator
 import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import reduce
 from io import BytesIO
 
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Q, Value, When
 from django.utils import timezone
 
-from images.utils import get_b2_resource
-from PIL import Image as PILImage, ImageOps
+from images import cache as redirect_cache, file_cache, pool, processing
+from images.locks import single_flight
+from images.notifications import notify_new_tasks
+from images.stats import BatchedCounter
+from images.storage import get_storage
+from images.utils import variant_file_name
+from PIL import Image as PILImage
 
 
 class Image(models.Model):
@@ -21,6 +34,7 @@ class Image(models.Model):
     model_version = models.IntegerField(default=1)
     height = models.IntegerField(default=0)
     width = models.IntegerField(default=0)
+    variant_catalog = models.JSONField(default=list)
 
     @property
     def thumbnail_size(self):
@@ -33,85 +47,267 @@ class Image(models.Model):
     def backblaze_filepath(self):
         return f"{self.id.hex[:2]}/{self.id.hex[2:4]}/{self.id.hex}"
 
+    def available_file_types(self, width, height):
+        if not self.variant_catalog:
+            self.refresh_variant_catalog()
+
+        return {
+            file_type
+            for variant_width, variant_height, file_type in self.variant_catalog
+            if variant_width == width and variant_height == height
+        }
+
+    def nearest_variant_size(self, width, height, file_types):
+        """
+        Smallest stored size of at least width x height available in one of
+        file_types, falling back to the size of the original.
+        """
+        sizes = [
+            (variant_width, variant_height)
+            for variant_width, variant_height, file_type in self.variant_catalog
+            if variant_width >= width
+            and variant_height >= height
+            and file_type in file_types
+        ]
+
+        return min(sizes, default=(self.width, self.height))
+
+    def refresh_variant_catalog(self):
+        self.variant_catalog = [
+            list(variant)
+            for variant in self.imagevariant_set.order_by(
+                "width", "height", "file_type"
+            ).values_list("width", "height", "file_type")
+        ]
+        Image.objects.filter(id=self.id).update(variant_catalog=self.variant_catalog)
+
+    def add_variant(self, width, height, file_type, is_full_size=False, generation=1):
+        with transaction.atomic():
+            # Lock the image row so concurrent writers rebuild the catalog
+            # one after the other and never drop each other's entries.
+            Image.objects.select_for_update().only("id").get(id=self.id)
+
+            image_variant, _ = ImageVariant.objects.get_or_create(
+                image=self,
+                height=height,
+                width=width,
+                file_type=file_type,
+                defaults={
+                    "is_full_size": is_full_size,
+                    "generation": 0 if is_full_size else generation,
+                },
+            )
+
+            self.refresh_variant_catalog()
+
+        transaction.on_commit(lambda: redirect_cache.invalidate(self.id))
+
+        return image_variant
+
+    def add_variants(self, sizes):
+        """
+        Record several (width, height, file_type) variants at once.
+        """
+        with transaction.atomic():
+            Image.objects.select_for_update().only("id").get(id=self.id)
+
+            ImageVariant.objects.bulk_create(
+                [
+                    ImageVariant(
+                        image=self,
+                        height=height,
+                        width=width,
+                        file_type=file_type,
+                        is_full_size=(height == self.height and width == self.width),
+                        generation=(
+                            0 if height == self.height and width == self.width else 1
+                        ),
+                    )
+                    for width, height, file_type in sizes
+                ],
+                ignore_conflicts=True,
+            )
+
+            self.refresh_variant_catalog()
+
+        transaction.on_commit(lambda: redirect_cache.invalidate(self.id))
+
     def create_variant_tasks(self, width, height, original_file_type):
-        ImageVariantTask(
-            image=self,
-            height=height,
-            width=width,
-            original_file_type=original_file_type,
-            file_type="avif",
-        ).save()
-
-        ImageVariantTask(
-            image=self,
-            height=height,
-            width=width,
-            original_file_type=original_file_type,
-            file_type="webp",
-        ).save()
-
-        ImageVariantTask(
-            image=self,
-            height=height,
-            width=width,
-            original_file_type=original_file_type,
-            file_type="jpegli",
-        ).save()
+        ImageVariantTask.objects.bulk_create(
+            [
+                ImageVariantTask(
+                    image=self,
+                    height=height,
+                    width=width,
+                    original_file_type=original_file_type,
+                    file_type=file_type,
+                )
+                for file_type in ["avif", "webp", "jpegli"]
+            ],
+            ignore_conflicts=True,
+        )
+
+        transaction.on_commit(notify_new_tasks)
 
     def create_variant(self, width, height):
-        bucket = get_b2_resource()
-
-        original_image = BytesIO()
-        original_variant = self.imagevariant_set.filter(
-            is_full_size=True, file_type__in=["jpg", "png"]
-        ).first()
-        bucket.download_fileobj(
-            f"{self.backblaze_filepath}/{original_variant.width}-{original_variant.height}/image.{original_variant.file_type}",
-            original_image,
-        )
-        original_image.seek(0)
+        """
+        Generate a variant of this size, unless another worker just did.
+        Raises admission.GenerationBusy when all the generation slots of the
+        node are taken.
+        """
+        # admission depends on the models, through authorization
+        from images import admission
 
-        resized_image = BytesIO()
+        with single_flight(f"variant-{self.id.hex}-{width}-{height}"):
+            # Another worker may have generated this size while we waited
+            self.refresh_from_db(fields=["variant_catalog"])
+            file_types = self.available_file_types(width, height) & {"jpg", "png"}
+            if file_types:
+                return self.imagevariant_set.get(
+                    width=width, height=height, file_type=min(file_types)
+                )
 
-        file_extension = "jpg"
+            # Taken last, so that requests waiting for the same size don't
+            # hold slots
+            with admission.generation_slot() as admitted:
+                if not admitted:
+                    raise admission.GenerationBusy()
 
-        with PILImage.open(original_image) as im:
-            ImageOps.exif_transpose(im, in_place=True)
-            im.thumbnail((width, height))
+                return self._generate_variant(width, height)
 
-            if im.has_transparency_data:
-                try:
-                    im.save(resized_image, "PNG")
-                    file_extension = "png"
-                except OSError:
-                    im.convert("RGB").save(resized_image, "JPEG")
-            else:
-                try:
-                    im.save(resized_image, "JPEG")
-                except OSError:
-                    im.convert("RGB").save(resized_image, "JPEG")
+    @property
+    def original_path(self):
+        original_file_type = min(
+            self.available_file_types(self.width, self.height) & {"jpg", "png"}
+        )
 
-        resized_image.seek(0)
+        return f"{self.backblaze_filepath}/{self.width}-{self.height}/image.{original_file_type}"
 
-        bucket.upload_fileobj(
-            resized_image,
-            f"{self.backblaze_filepath}/{width}-{height}/image.{file_extension}",
+    def _store_variant(self, width, height, data, file_extension):
+        resized_image_key = (
+            f"{self.backblaze_filepath}/{width}-{height}/image.{file_extension}"
         )
+        file_cache.store(resized_image_key, BytesIO(data))
+        get_storage().put(resized_image_key, BytesIO(data))
+
+    def resize_source(self, width, height):
+        """
+        Smallest jpg or png variant of at least width x height that is less
+        than VARIANT_MAX_GENERATION resizes away from the original, or the
+        original when there is none.
+        """
+        variants = self.imagevariant_set.filter(file_type__in=["jpg", "png"])
+
+        return (
+            variants.filter(
+                width__gte=width,
+                height__gte=height,
+                generation__lt=settings.VARIANT_MAX_GENERATION,
+            )
+            .order_by("width", "height", "file_type")
+            .first()
+        ) or variants.filter(is_full_size=True).order_by("file_type").first()
+
+    def _generate_variant(self, width, height):
+        source = self.resize_source(width, height)
 
-        image_variant = ImageVariant(
-            image=self,
-            height=height,
-            width=width,
-            is_full_size=False,
-            file_type=file_extension,
+        source_key = f"{self.backblaze_filepath}/{source.width}-{source.height}/image.{source.file_type}"
+        resize_args = (
+            (width, height),
+            settings.RESIZE_RESAMPLE,
+            settings.RESIZE_REDUCING_GAP,
         )
+        if settings.RESIZE_POOL_WORKERS:
+            # Workers open the file themselves rather than receiving its bytes
+            with file_cache.object_path(source_key) as source_path:
+                data, file_extension = pool.run(
+                    processing.resize_variant, source_path, *resize_args
+                )
+        else:
+            with file_cache.open_object(source_key) as source_image:
+                data, file_extension = processing.resize_variant(
+                    source_image, *resize_args
+                )
+
+        self._store_variant(width, height, data, file_extension)
 
-        image_variant.save()
+        image_variant = self.add_variant(
+            width, height, file_extension, generation=source.generation + 1
+        )
 
         self.create_variant_tasks(width, height, file_extension)
 
         return image_variant
 
+    def _store_resized(self, width, height, im):
+        data, file_extension = processing.save_variant(im)
+        self._store_variant(width, height, data, file_extension)
+
+        return file_extension
+
+    @property
+    def eager_variant_sizes(self):
+        sizes = {self.thumbnail_size}
+        for width in settings.EAGER_VARIANT_WIDTHS:
+            if width < self.width:
+                sizes.add((width, int(width * self.height / self.width)))
+
+        return {
+            (width, height)
+            for width, height in sizes
+            if not self.available_file_types(width, height) & {"jpg", "png"}
+        }
+
+    def create_eager_variants(self, original_image=None):
+        """
+        Generate the thumbnail and the EAGER_VARIANT_WIDTHS sizes the image
+        doesn't have yet, decoding the original only once. original_image is
+        an open file of the original, when the caller already has one.
+        """
+        sizes = self.eager_variant_sizes
+        if not sizes:
+            return
+
+        if original_image is None:
+            original_file = file_cache.open_object(self.original_path)
+        else:
+            original_file = nullcontext(original_image)
+
+        with ThreadPoolExecutor(
+            max_workers=settings.BATCH_UPLOAD_WORKERS
+        ) as executor, original_file as original_image, PILImage.open(
+            original_image
+        ) as im:
+            processing.open_for_resize(
+                im,
+                (max(width for width, _ in sizes), max(height for _, height in sizes)),
+                settings.RESIZE_REDUCING_GAP,
+            )
+
+            futures = {
+                executor.submit(self._store_resized, width, height, resized): (
+                    width,
+                    height,
+                )
+                for (width, height), resized in processing.resize_many(
+                    im,
+                    sizes,
+                    settings.EAGER_VARIANT_CASCADE_RATIO,
+                    resample=settings.RESIZE_RESAMPLE,
+                    reducing_gap=settings.RESIZE_REDUCING_GAP,
+                )
+            }
+
+            variants = [
+                (width, height, future.result())
+                for future, (width, height) in futures.items()
+            ]
+
+        with transaction.atomic():
+            self.add_variants(variants)
+            for width, height, file_extension in variants:
+                self.create_variant_tasks(width, height, file_extension)
+
 
 class ImageVariant(models.Model):
     image = models.ForeignKey(Image, on_delete=models.CASCADE)
@@ -119,6 +315,98 @@ class ImageVariant(models.Model):
     width = models.IntegerField()
     is_full_size = models.BooleanField(default=False)
     file_type = models.CharField(max_length=10)
+    # Number of resizes since the original
+    generation = models.IntegerField(default=1)
+    hits = models.BigIntegerField(default=0)
+    last_accessed = models.DateTimeField(default=timezone.now)
+
+    @property
+    def file_path(self):
+        return f"{self.image.backblaze_filepath}/{self.width}-{self.height}/{variant_file_name(self.file_type)}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["image", "width", "height", "file_type"],
+                name="unique_image_variant",
+            ),
+        ]
+
+
+def _add_counts(model, fields, counts, counter_field, output_field, **updates):
+    """
+    Add the count of each key of counts, a tuple of the values of fields, to
+    counter_field of the matching rows, 100 keys per query. updates are set
+    on those rows too.
+    """
+    counts = list(counts.items())
+    for index in range(0, len(counts), 100):
+        batch = counts[index : index + 100]
+        conditions = [Q(**dict(zip(fields, key))) for key, _ in batch]
+
+        model.objects.filter(reduce(operator.or_, conditions)).update(
+            **{
+                counter_field: F(counter_field)
+                + Case(
+                    *[
+                        When(condition, then=Value(count))
+                        for condition, (_, count) in zip(conditions, batch)
+                    ],
+                    default=Value(0),
+                    output_field=output_field,
+                )
+            },
+            **updates,
+        )
+
+
+def add_variant_hits(counts):
+    """
+    Add the request count of each (image id, width, height, file type) to
+    the hits of its variant, and mark it as accessed now.
+    """
+    _add_counts(
+        ImageVariant,
+        ["image_id", "width", "height", "file_type"],
+        counts,
+        "hits",
+        models.BigIntegerField(),
+        last_accessed=timezone.now(),
+    )
+
+
+variant_hits = BatchedCounter(add_variant_hits)
+
+
+# Task priorities grow with how often their size is requested, and decrease
+# with their creation date, so that a task that waits long enough ends up
+# being claimed before newer ones, however popular they are.
+TASK_PRIORITY_EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def initial_task_priority(created_at=None):
+    age = (created_at or timezone.now()) - TASK_PRIORITY_EPOCH
+    return -settings.TASK_PRIORITY_AGING * age.total_seconds() / 3600
+
+
+def add_task_priorities(counts):
+    """
+    Raise the priority of the tasks of each (image id, width, height) by its
+    request count.
+    """
+    _add_counts(
+        ImageVariantTask,
+        ["image_id", "width", "height"],
+        {
+            key: count * settings.TASK_PRIORITY_HIT_WEIGHT
+            for key, count in counts.items()
+        },
+        "priority",
+        models.FloatField(),
+    )
+
+
+task_requests = BatchedCounter(add_task_priorities)
 
 
 class ImageVariantTask(models.Model):
@@ -129,6 +417,92 @@ class ImageVariantTask(models.Model):
     width = models.IntegerField()
     original_file_type = models.CharField(max_length=10)
     file_type = models.CharField(max_length=10)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    leased_by = models.CharField(max_length=150, blank=True)
+    lease_token = models.UUIDField(null=True, blank=True, db_index=True)
+    attempts = models.IntegerField(default=0)
+    priority = models.FloatField(default=initial_task_priority)
+
+    @property
+    def upload_path(self):
+        return f"{self.image.backblaze_filepath}/{self.width}-{self.height}/{variant_file_name(self.file_type)}"
+
+    @property
+    def source_path(self):
+        return f"{self.image.backblaze_filepath}/{self.width}-{self.height}/image.{self.original_file_type}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["image", "width", "height", "file_type"],
+                name="unique_image_variant_task",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["file_type", "leased_until"]),
+            models.Index(fields=["file_type", "-priority"]),
+        ]
+
+    @classmethod
+    def complete(cls, tasks):
+        """
+        Record the variants produced by tasks whose files have been stored,
+        and delete the tasks.
+        """
+        tasks_by_image = defaultdict(list)
+        for task in tasks:
+            tasks_by_image[task.image].append(task)
+
+        with transaction.atomic():
+            for image, image_tasks in tasks_by_image.items():
+                image.add_variants(
+                    [(task.width, task.height, task.file_type) for task in image_tasks]
+                )
+
+            cls.objects.filter(id__in=[task.id for task in tasks]).delete()
+
+    @classmethod
+    def available(cls, file_type):
+        now = timezone.now()
+
+        return cls.objects.filter(
+            Q(leased_until__isnull=True) | Q(leased_until__lt=now),
+            file_type=file_type,
+            attempts__lt=settings.TASK_MAX_ATTEMPTS,
+        )
+
+    @classmethod
+    def claim(cls, file_type, limit, lease_duration, worker=""):
+        """
+        Lease up to `limit` tasks of a type that aren't leased yet, or whose
+        lease expired, to a worker for `lease_duration` seconds. Each lease
+        counts as an attempt.
+        """
+        lease_token = uuid.uuid4()
+
+        with transaction.atomic():
+            task_ids = (
+                cls.available(file_type)
+                .order_by("-priority")
+                .values_list("id", flat=True)[:limit]
+            )
+            if connection.features.has_select_for_update_skip_locked:
+                # Tasks being claimed by another worker are skipped rather than
+                # waited for
+                task_ids = list(task_ids.select_for_update(skip_locked=True))
+
+            # Otherwise task_ids stays a subquery of the UPDATE: a single
+            # statement takes the write lock right away, instead of a read
+            # lock that concurrent claims would all try to upgrade
+            cls.available(file_type).filter(id__in=task_ids).update(
+                leased_until=timezone.now() + timedelta(seconds=lease_duration),
+                leased_by=worker,
+                lease_token=lease_token,
+                attempts=F("attempts") + 1,
+            )
+
+        # Only the tasks this very call leased
+        return list(cls.objects.filter(lease_token=lease_token).order_by("-priority"))
 
 
 class AuthorizationKey(models.Model):
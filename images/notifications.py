@@ -0,0 +1,37 @@
+import threading
+import time
+
+from django.conf import settings
+
+_condition = threading.Condition()
+_generation = 0
+
+
+def notify_new_tasks():
+    global _generation
+
+    with _condition:
+        _generation += 1
+        _condition.notify_all()
+
+
+def wait_for_tasks(check, timeout):
+    """
+    Call `check` until it returns something truthy or `timeout` seconds have
+    passed. We wake up as soon as tasks get created by this process, and
+    every TASK_POLL_INTERVAL seconds to see those created by other processes.
+    """
+    deadline = time.monotonic() + timeout
+
+    while True:
+        with _condition:
+            generation = _generation
+
+        result = check()
+        remaining = deadline - time.monotonic()
+        if result or remaining <= 0:
+            return result
+
+        with _condition:
+            if _generation == generation:
+                _condition.wait(min(settings.TASK_POLL_INTERVAL, remaining))
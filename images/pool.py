@@ -0,0 +1,110 @@
+"""
+A pool of processes for the CPU-bound image work of web requests, so that a
+large resize doesn't hold the GIL of a web worker. Jobs must be picklable
+functions from images.processing, which doesn't depend on Django.
+"""
+
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_job_count = 0
+
+
+def _init_worker():
+    # Interrupts are meant for the web worker, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError()
+
+
+def _call(timeout, function, args):
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.alarm(timeout)
+    try:
+        return function(*args)
+    finally:
+        signal.alarm(0)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+
+    with _lock:
+        # A forked web worker can't use the processes of its parent's pool
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.RESIZE_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+            _executor_pid = os.getpid()
+
+        return _executor
+
+
+def _discard_executor(executor):
+    global _executor
+
+    with _lock:
+        if _executor is executor:
+            _executor = None
+
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run(function, *args):
+    """
+    Run function(*args) in the pool and return its result. Raises PoolBusy
+    when RESIZE_POOL_QUEUE_SIZE jobs are already waiting for a process, and
+    PoolTimeout when the job runs for more than RESIZE_POOL_TIMEOUT seconds.
+    Without RESIZE_POOL_WORKERS, function runs in the calling thread.
+    """
+    global _job_count
+
+    if not settings.RESIZE_POOL_WORKERS:
+        return function(*args)
+
+    executor = _get_executor()
+
+    with _lock:
+        if _job_count >= settings.RESIZE_POOL_WORKERS + settings.RESIZE_POOL_QUEUE_SIZE:
+            raise PoolBusy()
+
+        _job_count += 1
+
+    try:
+        future = executor.submit(_call, settings.RESIZE_POOL_TIMEOUT, function, args)
+
+        # The alarm can't interrupt a long call into a C library, so the wait
+        # is bounded too, leaving the job some time to be started.
+        return future.result(timeout=2 * settings.RESIZE_POOL_TIMEOUT)
+    except TimeoutError:
+        raise PoolTimeout()
+    except BrokenProcessPool:
+        # A process died, likely killed for its memory use. Later jobs get a
+        # new pool.
+        _discard_executor(executor)
+        raise
+    finally:
+        with _lock:
+            _job_count -= 1
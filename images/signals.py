@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from images import authorization
+from images.models import AuthorizationKey
+
+
+@receiver(post_save, sender=AuthorizationKey)
+@receiver(post_delete, sender=AuthorizationKey)
+def invalidate_authorization_key(sender, instance, **kwargs):
+    authorization.invalidate(instance.id)
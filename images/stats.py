@@ -0,0 +1,57 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedCounter:
+    """
+    Counts events in memory and hands the totals to `flush` from a background
+    thread every STATS_FLUSH_INTERVAL seconds, so that counting an event never
+    waits on the database.
+    """
+
+    def __init__(self, flush):
+        self.flush_counts = flush
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.pid = None
+
+    def _start(self):
+        # Called with the lock held, once per process: a forked child doesn't
+        # inherit the flushing thread and mustn't flush its parent's counts
+        self.counts = Counter()
+        self.pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, key, count=1):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._start()
+
+            self.counts[key] += count
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+
+        if not counts:
+            return
+
+        try:
+            self.flush_counts(counts)
+        except Exception:
+            logger.exception("Flushing %s counts failed", len(counts))
+        finally:
+            connection.close()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.STATS_FLUSH_INTERVAL)
+            self.flush()
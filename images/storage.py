@@ -0,0 +1,337 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from images.utils import get_s3_client, get_transfer_config
+
+_storage_lock = threading.Lock()
+_storage = None
+
+
+class SpooledWriter:
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+        )
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.seek(0)
+        self.storage.put(self.key, self.file)
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+
+
+class Storage:
+    """
+    Object storage for image files. Keys are "/" separated paths, and list()
+    yields them in lexicographic order, like S3 does.
+
+    open_writer() returns an object with write(data), commit() and abort()
+    methods, to store a file as it is being received.
+    """
+
+    def open_writer(self, key):
+        return SpooledWriter(self, key)
+
+    def put(self, key, fileobj):
+        raise NotImplementedError
+
+    def get(self, key, fileobj):
+        raise NotImplementedError
+
+    def copy(self, source_key, key):
+        raise NotImplementedError
+
+    def delete(self, keys):
+        """
+        Delete keys, ignoring missing ones, and return the keys that couldn't
+        be deleted.
+        """
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def copy_many(self, keys):
+        for source_key, key in keys:
+            self.copy(source_key, key)
+
+
+class S3Writer:
+    """
+    Streams a file to a multipart upload one part at a time, or to a single
+    PutObject if it turns out smaller than a part.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def _upload_part(self):
+        client = get_s3_client()
+
+        if self.upload_id is None:
+            self.upload_id = client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+
+        part_number = len(self.parts) + 1
+        response = client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+
+        if len(self.buffer) >= settings.S3_MULTIPART_CHUNKSIZE:
+            self._upload_part()
+
+    def commit(self):
+        if self.upload_id is None:
+            get_s3_client().put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer)
+            )
+            return
+
+        if self.buffer:
+            self._upload_part()
+
+        get_s3_client().complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            get_s3_client().abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+
+
+class S3Storage(Storage):
+    # Maximum number of keys of a DeleteObjects request
+    DELETE_BATCH_SIZE = 1000
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket or settings.S3_BUCKET
+
+    def open_writer(self, key):
+        return S3Writer(self.bucket, key)
+
+    def put(self, key, fileobj):
+        get_s3_client().upload_fileobj(
+            fileobj, self.bucket, key, Config=get_transfer_config()
+        )
+
+    def get(self, key, fileobj):
+        get_s3_client().download_fileobj(
+            self.bucket, key, fileobj, Config=get_transfer_config()
+        )
+
+    def copy(self, source_key, key):
+        get_s3_client().copy(
+            {"Bucket": self.bucket, "Key": source_key},
+            self.bucket,
+            key,
+            Config=get_transfer_config(),
+        )
+
+    def delete(self, keys):
+        keys = list(keys)
+        failed_keys = []
+        for index in range(0, len(keys), self.DELETE_BATCH_SIZE):
+            # Quiet responses only list the keys that failed
+            response = get_s3_client().delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [
+                        {"Key": key}
+                        for key in keys[index : index + self.DELETE_BATCH_SIZE]
+                    ],
+                    "Quiet": True,
+                },
+            )
+            failed_keys += [error["Key"] for error in response.get("Errors", [])]
+
+        return failed_keys
+
+    def list(self, prefix=""):
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"]
+
+    def exists(self, key):
+        try:
+            get_s3_client().head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+
+        return True
+
+
+class LocalWriter:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, self.temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix="."
+        )
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.temporary_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.temporary_path)
+
+
+class LocalStorage(Storage):
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def open_writer(self, key):
+        return LocalWriter(self._path(key))
+
+    def put(self, key, fileobj):
+        writer = self.open_writer(key)
+        try:
+            shutil.copyfileobj(fileobj, writer)
+        except BaseException:
+            writer.abort()
+            raise
+
+        writer.commit()
+
+    def get(self, key, fileobj):
+        with open(self._path(key), "rb") as file:
+            shutil.copyfileobj(file, fileobj)
+
+    def copy(self, source_key, key):
+        with open(self._path(source_key), "rb") as file:
+            self.put(key, file)
+
+    def delete(self, keys):
+        failed_keys = []
+        for key in keys:
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                failed_keys.append(key)
+
+        return failed_keys
+
+    def _walk(self, path, key_prefix):
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            return
+
+        # Sorting directories as "name/" yields full keys in the same
+        # lexicographic order as S3
+        entries.sort(key=lambda e: e.name + "/" if e.is_dir() else e.name)
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+
+            if entry.is_dir():
+                yield from self._walk(entry.path, key_prefix + entry.name + "/")
+            else:
+                yield key_prefix + entry.name
+
+    def list(self, prefix=""):
+        directory, _, _ = prefix.rpartition("/")
+        key_prefix = directory + "/" if directory else ""
+
+        for key in self._walk(self._path(directory), key_prefix):
+            if key.startswith(prefix):
+                yield key
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put(self, key, fileobj):
+        data = fileobj.read()
+        with self.lock:
+            self.objects[key] = data
+
+    def get(self, key, fileobj):
+        with self.lock:
+            data = self.objects[key]
+        fileobj.write(data)
+
+    def copy(self, source_key, key):
+        with self.lock:
+            self.objects[key] = self.objects[source_key]
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.objects.pop(key, None)
+
+        return []
+
+    def list(self, prefix=""):
+        with self.lock:
+            keys = sorted(key for key in self.objects if key.startswith(prefix))
+        yield from keys
+
+    def exists(self, key):
+        with self.lock:
+            return key in self.objects
+
+
+def get_storage():
+    global _storage
+
+    with _storage_lock:
+        if _storage is None:
+            _storage = import_string(settings.STORAGE_BACKEND)(
+                **settings.STORAGE_OPTIONS
+            )
+
+        return _storage
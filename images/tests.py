@@ -1,3 +1,71 @@
-from django.test import TestCase
+import math
+from io import BytesIO
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from PIL import ExifTags, Image as PILImage, ImageChops, ImageOps, ImageStat
+
+from images import processing
+
+
+def psnr(im, reference):
+    mean_square_errors = [
+        rms**2 for rms in ImageStat.Stat(ImageChops.difference(im, reference)).rms
+    ]
+    mean_square_error = sum(mean_square_errors) / len(mean_square_errors)
+    if mean_square_error == 0:
+        return math.inf
+
+    return 10 * math.log10(255**2 / mean_square_error)
+
+
+class ResizeVariantTestCase(SimpleTestCase):
+    # Draft decoding and reducing_gap trade a little quality for speed, this
+    # is how much
+    PSNR_FLOOR = 33
+
+    def make_jpeg(self, size, orientation=None):
+        im = PILImage.merge(
+            "RGB",
+            [
+                PILImage.linear_gradient("L").resize(size),
+                PILImage.radial_gradient("L").resize(size),
+                PILImage.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 100),
+            ],
+        )
+
+        exif = PILImage.Exif()
+        if orientation is not None:
+            exif[ExifTags.Base.Orientation] = orientation
+
+        output = BytesIO()
+        im.save(output, "JPEG", quality=95, exif=exif)
+
+        return output.getvalue()
+
+    def reference(self, data, box):
+        with PILImage.open(BytesIO(data)) as im:
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail(box)
+
+            return im
+
+    def assert_close_to_reference(self, data, box):
+        resized_data, file_extension = processing.resize_variant(BytesIO(data), box)
+        self.assertEqual(file_extension, "jpg")
+
+        reference = self.reference(data, box)
+        with PILImage.open(BytesIO(resized_data)) as im:
+            self.assertEqual(im.size, reference.size)
+            self.assertGreater(psnr(im.convert("RGB"), reference), self.PSNR_FLOOR)
+
+    def test_resize(self):
+        self.assert_close_to_reference(self.make_jpeg((1600, 1200)), (200, 200))
+
+    def test_resize_rotated(self):
+        # Orientation 6 is stored in landscape and shown in portrait
+        data = self.make_jpeg((1600, 1200), orientation=6)
+        self.assert_close_to_reference(data, (150, 400))
+
+        resized_data, _ = processing.resize_variant(BytesIO(data), (150, 400))
+        with PILImage.open(BytesIO(resized_data)) as im:
+            self.assertEqual(im.size, (150, 200))
@@ -0,0 +1,111 @@
+import hashlib
+import uuid
+from io import BytesIO
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+
+from images import file_cache
+from images.models import Image
+from images.storage import get_storage
+
+# Give up on identifying a file whose header doesn't fit in this many bytes.
+# EXIF, ICC and other metadata segments all come before the frame header.
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+
+FILE_EXTENSIONS = {"JPEG": "jpg", "PNG": "png"}
+
+
+class StreamedImage:
+    def __init__(self, handler, size):
+        self.name = handler.file_name
+        self.content_type = handler.content_type
+        self.size = size
+        self.image_id = handler.image_id
+        self.md5 = handler.md5.hexdigest()
+        self.file_extension = handler.file_extension
+        self.width = handler.width
+        self.height = handler.height
+        self.writer = handler.writer
+        self.local_writer = handler.local_writer
+
+
+class StreamingImageUploadHandler(FileUploadHandler):
+    """
+    Hash the uploaded image, read its format and size from its header and
+    send it to the storage as it is being received, in a single pass and
+    without keeping it in memory. When eager variants are made during the
+    upload, a local copy is written along, so that they don't download the
+    image back.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.image_id = uuid.uuid4()
+        self.writer = None
+        self.local_writer = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        if field_name != "file" or self.writer is not None:
+            raise SkipFile()
+
+        super().new_file(field_name, *args, **kwargs)
+
+        self.md5 = hashlib.md5()
+        self.header = bytearray()
+        self.next_identify_size = 0
+        self.file_extension = None
+        self.width = None
+        self.height = None
+
+    def _identify(self, complete=False):
+        try:
+            with PILImage.open(BytesIO(self.header)) as im:
+                image_format, self.width, self.height = im.format, im.width, im.height
+        except (OSError, SyntaxError):
+            # Pillow also fails this way on a header cut short
+            if complete or len(self.header) > MAX_HEADER_SIZE:
+                self.header = None
+            else:
+                # Parsing starts over each time, so wait for the header to
+                # double before trying again
+                self.next_identify_size = 2 * len(self.header)
+            return
+
+        self.file_extension = FILE_EXTENSIONS.get(image_format)
+        if self.file_extension is None:
+            self.header = None
+            return
+
+        key = f"{Image(id=self.image_id).backblaze_filepath}/{self.width}-{self.height}/image.{self.file_extension}"
+        self.writer = get_storage().open_writer(key)
+        self.writer.write(bytes(self.header))
+        if settings.EAGER_VARIANTS == "upload":
+            self.local_writer = file_cache.Writer(key)
+            self.local_writer.write(bytes(self.header))
+        self.header = None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.md5.update(raw_data)
+
+        if self.writer is not None:
+            self.writer.write(raw_data)
+            if self.local_writer is not None:
+                self.local_writer.write(raw_data)
+        elif self.header is not None:
+            self.header += raw_data
+            if len(self.header) >= self.next_identify_size:
+                self._identify()
+
+    def file_complete(self, file_size):
+        if self.writer is None and self.header is not None:
+            self._identify(complete=True)
+
+        return StreamedImage(self, file_size)
+
+    def upload_interrupted(self):
+        if self.writer is not None:
+            self.writer.abort()
+        if self.local_writer is not None:
+            self.local_writer.abort()
@@ -10,6 +10,21 @@ urlpatterns = [
         views.upload_variant,
         name="images.upload_variant",
     ),
+    path(
+        "conversion_tasks/upload_variants",
+        views.upload_variants,
+        name="images.upload_variants",
+    ),
+    path(
+        "conversion_tasks/<image_type>/claim",
+        views.claim_tasks,
+        name="images.claim_tasks",
+    ),
+    path(
+        "conversion_tasks/<image_type>/events",
+        views.task_events,
+        name="images.task_events",
+    ),
     path(
         "conversion_tasks/<image_type>",
         views.image_type_optimization_needed,
@@ -1,17 +1,101 @@
+import bisect
+import math
+import os
+import threading
+
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 from django.conf import settings
+from django.shortcuts import redirect
+
+_s3_client_lock = threading.Lock()
+_s3_client = None
+_s3_client_pid = None
+_transfer_config = None
+
+
+def get_s3_client():
+    global _s3_client, _s3_client_pid
+
+    with _s3_client_lock:
+        # Clients are thread safe, but their connection pool must not be
+        # shared with a forked child
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            _s3_client = boto3.session.Session().client(
+                service_name="s3",
+                endpoint_url=settings.S3_ENDPOINT,
+                aws_access_key_id=settings.S3_KEY_ID,
+                aws_secret_access_key=settings.S3_ACCESS_KEY,
+                config=Config(
+                    signature_version="s3v4",
+                    max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=settings.S3_TCP_KEEPALIVE,
+                    retries={
+                        "total_max_attempts": settings.S3_MAX_ATTEMPTS,
+                        "mode": settings.S3_RETRY_MODE,
+                    },
+                ),
+            )
+            _s3_client_pid = os.getpid()
+
+        return _s3_client
+
+
+def get_transfer_config():
+    global _transfer_config
+
+    if _transfer_config is None:
+        _transfer_config = TransferConfig(
+            multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=settings.S3_MAX_CONCURRENCY,
+        )
+
+    return _transfer_config
+
+
+def snap_to_ladder(size, full_size):
+    """
+    Round a requested size up to the next rung of the configured ladder.
+    Sizes above the last rung, or at least full_size, snap to full_size.
+    """
+    if settings.SIZE_LADDER:
+        ladder = sorted(settings.SIZE_LADDER)
+        index = bisect.bisect_left(ladder, size)
+        if index == len(ladder):
+            return full_size
+
+        return min(ladder[index], full_size)
+
+    if settings.SIZE_LADDER_STEP:
+        rung = settings.SIZE_LADDER_MIN
+        while rung < size and rung < full_size:
+            rung = math.ceil(rung * (1 + settings.SIZE_LADDER_STEP / 100))
+
+        return min(rung, full_size)
+
+    return min(size, full_size)
+
+
+def redirect_with_size(url, width, height):
+    response = redirect(url)
+    response["X-Image-Width"] = width
+    response["X-Image-Height"] = height
+
+    return response
+
+
+def variant_file_name(file_type):
+    if file_type == "jpegli":
+        return "jpegli.jpg"
 
+    return "image." + file_type
 
-def get_b2_resource():
-    b2 = boto3.resource(
-        service_name="s3",
-        endpoint_url=settings.S3_ENDPOINT,
-        aws_access_key_id=settings.S3_KEY_ID,
-        aws_secret_access_key=settings.S3_ACCESS_KEY,
-        config=Config(signature_version="s3v4"),
-    )
 
-    bucket = b2.Bucket(settings.S3_BUCKET)
+def file_type_from_url(url):
+    file_name = url.rsplit("/", 1)[-1]
+    if file_name == "jpegli.jpg":
+        return "jpegli"
 
-    return bucket
+    return file_name.rsplit(".", 1)[-1]
@@ -1,26 +1,41 @@
-import hashlib
+import json
+import logging
+import math
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
-from PIL import Image as PILImage
 from PIL import JpegImagePlugin
 from django.conf import settings
 from django.http import (
     JsonResponse,
     HttpResponseBadRequest,
     HttpResponseNotFound,
+    StreamingHttpResponse,
 )
-from django.shortcuts import redirect, render
+from django.shortcuts import render
+from django.utils.cache import add_never_cache_headers
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
+from images import admission, background, pool
 from images.decorators import (
+    cache_redirect,
     get_image,
     can_upload_variant,
     can_upload_image,
 )
-from images.models import Image, ImageVariant, ImageVariantTask
-from images.utils import get_b2_resource
+from images.models import Image, ImageVariantTask, task_requests, variant_hits
+from images.notifications import wait_for_tasks
+from images.storage import get_storage
+from images.uploads import StreamingImageUploadHandler
+from images.utils import redirect_with_size, snap_to_ladder, variant_file_name
 
 JpegImagePlugin._getmp = lambda x: None
 
+logger = logging.getLogger(__name__)
+
 
 def index(request):
     return render(request, "index.html")
@@ -29,79 +44,156 @@ def index(request):
 @csrf_exempt
 @can_upload_image
 def upload(request):
-    file = request.FILES["file"]
-
-    bucket = get_b2_resource()
-
-    file_md5_hash = hashlib.file_digest(file, "md5").hexdigest()
-    file.seek(0)
-
-    with PILImage.open(file) as im:
-        height, width = (im.height, im.width)
+    request.upload_handlers = [StreamingImageUploadHandler(request)]
 
-        if im.format == "JPEG":
-            file_extension = "jpg"
-        elif im.format == "PNG":
-            file_extension = "png"
-        else:
-            return {"created": False, "error": "Uploaded file should be JPEG or PNG"}
+    file = request.FILES["file"]
 
-    file.seek(0)
+    if file.writer is None:
+        return JsonResponse(
+            {"created": False, "error": "Uploaded file should be JPEG or PNG"},
+            status=400,
+        )
 
-    same_md5_image = Image.objects.filter(original_md5=file_md5_hash).first()
+    same_md5_image = Image.objects.filter(original_md5=file.md5).first()
     if same_md5_image:
-        return {"created": False, "id": same_md5_image.id}
+        file.writer.abort()
+        if file.local_writer is not None:
+            file.local_writer.abort()
+        return JsonResponse({"created": False, "id": same_md5_image.id})
+
+    file.writer.commit()
 
     image = Image(
+        id=file.image_id,
         original_name=file.name,
         original_mime_type=file.content_type,
-        original_md5=file_md5_hash,
-        height=height,
-        width=width,
+        original_md5=file.md5,
+        height=file.height,
+        width=file.width,
         model_version=2,
     )
 
-    image.save()
-
-    bucket.upload_fileobj(
-        file, f"{image.backblaze_filepath}/{width}-{height}/image.{file_extension}"
-    )
+    image.save(force_insert=True)
 
-    ImageVariant.objects.get_or_create(
-        image=image,
-        height=height,
-        width=width,
-        file_type=file_extension,
-        is_full_size=True,
-    )
+    image.add_variant(file.width, file.height, file.file_extension, is_full_size=True)
 
-    image.create_variant_tasks(image.width, image.height, file_extension)
+    image.create_variant_tasks(image.width, image.height, file.file_extension)
     image.uploaded = True
     image.save()
 
+    if settings.EAGER_VARIANTS == "upload":
+        # The upload succeeded either way, missing sizes are made on demand
+        try:
+            with file.local_writer.commit() as original_image:
+                image.create_eager_variants(original_image)
+        except Exception:
+            logger.exception("Eager generation of %s failed", image.id)
+    elif settings.EAGER_VARIANTS == "background":
+        background.create_eager_variants(image)
+
     return JsonResponse({"created": True, "id": image.id})
 
 
+def task_json(task):
+    return {
+        "image_id": task.image_id,
+        "task_id": task.id,
+        "height": task.height,
+        "width": task.width,
+        "file_type": task.original_file_type,
+    }
+
+
+def get_wait_duration(value):
+    return max(0.0, min(float(value or 0), settings.TASK_LONG_POLL_MAX_WAIT))
+
+
+def get_lease_duration(value):
+    return max(
+        settings.TASK_LEASE_MIN_DURATION,
+        min(
+            int(value or settings.TASK_LEASE_DURATION),
+            settings.TASK_LEASE_MAX_DURATION,
+        ),
+    )
+
+
 @can_upload_variant
 def image_type_optimization_needed(request, image_type):
-    tasks = ImageVariantTask.objects.filter(file_type=image_type).all()
+    try:
+        wait_duration = get_wait_duration(request.GET.get("wait"))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    tasks = wait_for_tasks(
+        lambda: list(ImageVariantTask.objects.filter(file_type=image_type)),
+        wait_duration,
+    )
+
+    return JsonResponse({"variants": [task_json(task) for task in tasks]})
+
+
+@csrf_exempt
+@require_POST
+@can_upload_variant
+def claim_tasks(request, image_type):
+    try:
+        limit = max(
+            1, min(int(request.POST.get("limit", 10)), settings.TASK_CLAIM_MAX_LIMIT)
+        )
+        lease_duration = get_lease_duration(request.POST.get("lease"))
+        wait_duration = get_wait_duration(request.POST.get("wait"))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    tasks = wait_for_tasks(
+        lambda: ImageVariantTask.claim(
+            image_type, limit, lease_duration, request.POST.get("worker", "")
+        ),
+        wait_duration,
+    )
 
     return JsonResponse(
         {
             "variants": [
-                {
-                    "image_id": task.image.id,
-                    "task_id": task.id,
-                    "height": task.height,
-                    "width": task.width,
-                    "file_type": task.original_file_type,
-                }
-                for task in tasks
+                task_json(task) | {"leased_until": task.leased_until} for task in tasks
             ]
         }
     )
 
 
+@can_upload_variant
+def task_events(request, image_type):
+    """
+    Server-sent events stream announcing how many tasks of a type are waiting
+    to be claimed, each time that number changes. The stream ends after
+    TASK_EVENTS_MAX_DURATION seconds, clients are expected to reconnect.
+    """
+
+    def events():
+        deadline = time.monotonic() + settings.TASK_EVENTS_MAX_DURATION
+        last_count = None
+
+        while time.monotonic() < deadline:
+            count = ImageVariantTask.available(image_type).count()
+            if count != last_count:
+                yield f"event: tasks\ndata: {json.dumps({'count': count})}\n\n"
+                last_count = count
+            else:
+                yield ": keep-alive\n\n"
+
+            wait_for_tasks(
+                lambda: ImageVariantTask.available(image_type).count() != last_count,
+                settings.TASK_POLL_INTERVAL,
+            )
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+
+    return response
+
+
 @csrf_exempt
 @can_upload_variant
 def upload_variant(request):
@@ -119,22 +211,12 @@ def upload_variant(request):
     file_type = task.file_type
     file = request.FILES["file"]
 
-    if file_type == "jpegli":
-        file_name = "jpegli.jpg"
-    else:
-        file_name = "image." + file_type
-
-    upload_path = f"{image.backblaze_filepath}/{width}-{height}/{file_name}"
-
-    bucket = get_b2_resource()
-
-    bucket.upload_fileobj(file, upload_path)
+    get_storage().put(task.upload_path, file)
 
-    ImageVariant.objects.get_or_create(
-        image=image,
-        height=height,
-        width=width,
-        file_type=file_type,
+    image.add_variant(
+        width,
+        height,
+        file_type,
         is_full_size=(height == image.height and width == image.width),
     )
 
@@ -143,28 +225,157 @@ def upload_variant(request):
     return JsonResponse({"status": "ok"})
 
 
+@csrf_exempt
+@require_POST
+@can_upload_variant
+def upload_variants(request):
+    """
+    Complete several tasks at once. Each file of the request is named after
+    the id of the task it completes.
+    """
+    results = {}
+
+    task_ids = []
+    for task_id in request.FILES:
+        try:
+            task_ids.append(uuid.UUID(task_id))
+        except ValueError:
+            results[task_id] = "invalid"
+
+    tasks = {
+        str(task.id): task
+        for task in ImageVariantTask.objects.filter(id__in=task_ids).select_related(
+            "image"
+        )
+    }
+    for task_id in task_ids:
+        if str(task_id) not in tasks:
+            results[str(task_id)] = "not_found"
+
+    storage = get_storage()
+    uploaded_tasks = []
+
+    with ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_WORKERS) as executor:
+        futures = {
+            executor.submit(storage.put, task.upload_path, request.FILES[task_id]): task
+            for task_id, task in tasks.items()
+        }
+
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Upload of task %s failed", task.id)
+                results[str(task.id)] = "upload_failed"
+            else:
+                uploaded_tasks.append(task)
+
+    ImageVariantTask.complete(uploaded_tasks)
+
+    for task in uploaded_tasks:
+        results[str(task.id)] = "ok"
+
+    return JsonResponse({"results": results})
+
+
 def image_with_size(request, image, width, height, image_type):
-    image_variants = ImageVariant.objects.filter(
-        image=image, height=height, width=width
-    )
+    task_requests.add((image.id, width, height))
+
+    available_file_types = image.available_file_types(width, height)
     if image_type != "auto":
         if image_type == "original":
-            image_variants = image_variants.filter(file_type__in=["jpg", "png"])
+            available_file_types &= {"jpg", "png"}
         else:
-            image_variants = image_variants.filter(file_type=image_type)
+            available_file_types &= {image_type}
 
-    variants = image_variants.all()
-
-    if not variants:
+    if not available_file_types:
         if image_type != "auto" and image_type != "original":
             return JsonResponse({"error": "Image version not available"}, status=404)
+        elif settings.VARIANT_GENERATION_MODE == "background":
+            if admission.take_token(admission.client_key(request)):
+                admission.shed_counts.add("rate_limited")
+            else:
+                background.create_variant(image, width, height)
+
+            return redirect_to_nearest_variant(
+                request, image, width, height, image_type
+            )
         else:
-            image_variant = image.create_variant(width, height)
+            return create_variant(request, image, width, height, image_type)
+
+    return redirect_to_variant(
+        request, image, width, height, image_type, available_file_types
+    )
 
-            return redirect(
-                f"{settings.S3_PUBLIC_BASE_PATH}/{image.backblaze_filepath}/{width}-{height}/image.{image_variant.file_type}"
-            )
 
+def create_variant(request, image, width, height, image_type):
+    retry_after = admission.take_token(admission.client_key(request))
+    if retry_after:
+        return shed_generation(
+            request, image, width, height, image_type, "rate_limited", retry_after
+        )
+
+    try:
+        image_variant = image.create_variant(width, height)
+    except admission.GenerationBusy:
+        return shed_generation(request, image, width, height, image_type, "busy")
+    except (pool.PoolBusy, pool.PoolTimeout):
+        return shed_generation(request, image, width, height, image_type, "pool_busy")
+    except BrokenProcessPool:
+        # pool.run already replaced the pool for the next requests
+        return shed_generation(request, image, width, height, image_type, "pool_broken")
+
+    variant_hits.add((image.id, width, height, image_variant.file_type))
+
+    return redirect_with_size(
+        f"{settings.S3_PUBLIC_BASE_PATH}/{image.backblaze_filepath}/{width}-{height}/image.{image_variant.file_type}",
+        width,
+        height,
+    )
+
+
+def shed_generation(
+    request,
+    image,
+    width,
+    height,
+    image_type,
+    reason,
+    retry_after=None,
+):
+    admission.shed_counts.add(reason)
+    logger.info("Not generating %s at %sx%s: %s", image.id, width, height, reason)
+
+    if settings.VARIANT_GENERATION_SHED_MODE == "nearest":
+        return redirect_to_nearest_variant(request, image, width, height, image_type)
+
+    response = JsonResponse({"error": "Image version not available yet"}, status=503)
+    response["Retry-After"] = math.ceil(retry_after or settings.RESIZE_RETRY_AFTER)
+    return response
+
+
+def redirect_to_nearest_variant(request, image, width, height, image_type):
+    nearest_width, nearest_height = image.nearest_variant_size(
+        width, height, ["jpg", "png"]
+    )
+    available_file_types = image.available_file_types(nearest_width, nearest_height)
+    if image_type == "original":
+        available_file_types &= {"jpg", "png"}
+
+    response = redirect_to_variant(
+        request, image, nearest_width, nearest_height, image_type, available_file_types
+    )
+
+    # The exact size will exist soon, neither we nor the CDN should keep this
+    add_never_cache_headers(response)
+
+    return response
+
+
+def redirect_to_variant(
+    request, image, width, height, image_type, available_file_types
+):
     if image_type == "auto":
         variants_preferred_order = ["avif", "webp", "jpegli", "jpg", "png"]
     elif image_type == "original":
@@ -189,26 +400,25 @@ def image_with_size(request, image, width, height, image_type):
         ):
             continue
 
-        variant = [x for x in image_variants if x.file_type == file_type]
-        if not variant:
+        if file_type not in available_file_types:
             continue
 
-        variant = variant[0]
-
-        if file_type == "jpegli":
-            file_name = "jpegli.jpg"
-        else:
-            file_name = "image." + file_type
+        variant_hits.add((image.id, width, height, file_type))
 
-        return redirect(
-            f"{settings.S3_PUBLIC_BASE_PATH}/{image.backblaze_filepath}/{variant.width}-{variant.height}/{file_name}"
+        return redirect_with_size(
+            f"{settings.S3_PUBLIC_BASE_PATH}/{image.backblaze_filepath}/{width}-{height}/{variant_file_name(file_type)}",
+            width,
+            height,
         )
 
     return HttpResponseNotFound()
 
 
+@cache_redirect
 @get_image
 def get_image_with_height(request, image, height, image_type):
+    height = snap_to_ladder(height, image.height)
+
     if height >= image.height:
         height = image.height
         width = image.width
@@ -218,8 +428,11 @@ def get_image_with_height(request, image, height, image_type):
     return image_with_size(request, image, width, height, image_type)
 
 
+@cache_redirect
 @get_image
 def get_image_with_width(request, image, width, image_type):
+    width = snap_to_ladder(width, image.width)
+
     if width >= image.width:
         width = image.width
         height = image.height
@@ -229,11 +442,13 @@ def get_image_with_width(request, image, width, image_type):
     return image_with_size(request, image, width, height, image_type)
 
 
+@cache_redirect
 @get_image
 def get(request, image, image_type):
     return image_with_size(request, image, image.width, image.height, image_type)
 
 
+@cache_redirect
 @get_image
 def get_thumbnail(request, image, image_type):
     width, height = image.thumbnail_size
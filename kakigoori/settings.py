@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -116,4 +117,238 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+
+# Storage
+# STORAGE_BACKEND is the dotted path of an images.storage.Storage subclass,
+# built with STORAGE_OPTIONS as keyword arguments. LocalStorage takes a
+# "root" directory, S3_PUBLIC_BASE_PATH should then point to where it's
+# served from.
+
+STORAGE_BACKEND = "images.storage.S3Storage"
+
+STORAGE_OPTIONS = {}
+
+
+# S3 client
+# One client is shared by all the threads of a worker process.
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/retries.html
+
+S3_MAX_POOL_CONNECTIONS = 50
+
+S3_TCP_KEEPALIVE = True
+
+S3_MAX_ATTEMPTS = 5
+
+S3_RETRY_MODE = "standard"
+
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+
+S3_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+
+S3_MAX_CONCURRENCY = 8
+
+
+# Local file cache
+# Originals and freshly generated variants are kept in FILE_CACHE_DIR, up to
+# FILE_CACHE_MAX_BYTES, so that new sizes of the same image don't download the
+# original again. None disables the cache. Each process adds what it writes
+# to the size it last measured, and only measures the directory again once
+# that goes over budget or FILE_CACHE_SCAN_INTERVAL seconds have passed, to
+# see the writes of other processes.
+
+FILE_CACHE_DIR = None
+
+FILE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+FILE_CACHE_SCAN_INTERVAL = 60
+
+
+# Resolved redirect cache
+# Redirect targets are kept in a per-process LRU for REDIRECT_CACHE_TTL
+# seconds, up to REDIRECT_CACHE_MAX_ENTRIES_PER_IMAGE sizes and formats for
+# each of REDIRECT_CACHE_MAX_IMAGES images. Set REDIRECT_CACHE_BACKEND to the name of an entry of CACHES to
+# share them (and their invalidation) between workers. Each lookup then
+# checks the version of the image in that cache, and without it other
+# workers only see an invalidation once their entries expire.
+
+REDIRECT_CACHE_MAX_IMAGES = 10000
+
+REDIRECT_CACHE_MAX_ENTRIES_PER_IMAGE = 32
+
+REDIRECT_CACHE_TTL = 60
+
+REDIRECT_CACHE_BACKEND = None
+
+
+# Authorization cache
+# Each process remembers the permissions of up to AUTHORIZATION_CACHE_MAX_KEYS
+# authorization keys, including unknown ones, for AUTHORIZATION_CACHE_TTL
+# seconds. Changing or deleting a key clears it right away in the process
+# doing it, and after the TTL in the others.
+
+AUTHORIZATION_CACHE_TTL = 60
+
+AUTHORIZATION_CACHE_MAX_KEYS = 1000
+
+
+# Single-flight locks
+# On-demand variant generation is serialized per (image, width, height) with
+# lock files in LOCK_DIR, which must be shared by every worker of a node.
+
+LOCK_DIR = Path(tempfile.gettempdir()) / "kakigoori-locks"
+
+LOCK_STRIPES = 1024
+
+
+# On-demand variant generation
+# "sync" generates missing sizes while the request waits. "background"
+# redirects to the nearest larger existing variant right away and queues the
+# exact size on a pool of VARIANT_GENERATION_WORKERS threads.
+
+VARIANT_GENERATION_MODE = "sync"
+
+VARIANT_GENERATION_WORKERS = 2
+
+VARIANT_GENERATION_QUEUE_SIZE = 100
+
+# Admission control
+# At most VARIANT_GENERATION_SLOTS on-demand generations run at once on a
+# node (sharing LOCK_DIR), and each client may start VARIANT_GENERATION_RATE
+# per second, in bursts of up to VARIANT_GENERATION_BURST. Clients are told
+# apart by valid API key, then by VARIANT_GENERATION_CLIENT_HEADER (such as
+# "X-Forwarded-For" behind VARIANT_GENERATION_TRUSTED_PROXIES proxies that
+# each append the address they received the request from) or the remote
+# address, and the last VARIANT_GENERATION_RATE_CLIENTS are remembered by
+# each process. None disables a limit. Shed requests are redirected to the
+# nearest larger existing variant with VARIANT_GENERATION_SHED_MODE
+# "nearest", or get a 503 response with "503".
+
+VARIANT_GENERATION_SLOTS = None
+
+VARIANT_GENERATION_RATE = None
+
+VARIANT_GENERATION_BURST = 20
+
+VARIANT_GENERATION_CLIENT_HEADER = None
+
+VARIANT_GENERATION_TRUSTED_PROXIES = 1
+
+VARIANT_GENERATION_RATE_CLIENTS = 10000
+
+VARIANT_GENERATION_SHED_MODE = "nearest"
+
+
+# Resizing
+# RESIZE_RESAMPLE is a Pillow resampling filter name: "nearest", "box",
+# "bilinear", "hamming", "bicubic" or "lanczos", from fastest to sharpest.
+# JPEG originals are decoded at a reduced scale, and images are reduced by an
+# integer factor, down to RESIZE_REDUCING_GAP times the output size before
+# resampling. Higher gaps are slower and closer to a plain resample, None
+# disables both.
+
+RESIZE_RESAMPLE = "bicubic"
+
+RESIZE_REDUCING_GAP = 2.0
+
+# Missing sizes are resized from the smallest larger jpg or png variant
+# rather than from the original, unless that variant is already
+# VARIANT_MAX_GENERATION - 1 lossy resizes away from the original. 1 always
+# resizes from the original.
+
+VARIANT_MAX_GENERATION = 2
+
+
+# Resize pool
+# On-demand resizes run on RESIZE_POOL_WORKERS processes per web worker, or
+# on the request thread when it is 0. Requests are shed, as set by
+# VARIANT_GENERATION_SHED_MODE, when RESIZE_POOL_QUEUE_SIZE resizes are
+# already waiting for a process or when a resize takes longer than
+# RESIZE_POOL_TIMEOUT seconds. 503 responses ask clients to retry after
+# RESIZE_RETRY_AFTER seconds.
+
+RESIZE_POOL_WORKERS = 0
+
+RESIZE_POOL_QUEUE_SIZE = 4
+
+RESIZE_POOL_TIMEOUT = 30
+
+RESIZE_RETRY_AFTER = 5
+
+
+# Eager variant generation
+# When set to "upload" (while the upload request waits) or "background" (on
+# the variant generation pool), uploads also generate the thumbnail and the
+# EAGER_VARIANT_WIDTHS sizes, decoding the original once. A size is resized
+# from the previous, larger one when that is at least
+# EAGER_VARIANT_CASCADE_RATIO times larger, from the original otherwise.
+
+EAGER_VARIANTS = None
+
+EAGER_VARIANT_WIDTHS = []
+
+EAGER_VARIANT_CASCADE_RATIO = 2
+
+
+# Conversion tasks
+# Tasks claimed by an encoder worker are hidden from other workers for
+# TASK_LEASE_DURATION seconds, or the lease duration it asked for within
+# TASK_LEASE_MIN_DURATION and TASK_LEASE_MAX_DURATION.
+
+TASK_LEASE_DURATION = 300
+
+TASK_LEASE_MIN_DURATION = 30
+
+TASK_LEASE_MAX_DURATION = 3600
+
+TASK_CLAIM_MAX_LIMIT = 100
+
+# A task is given up on once it was claimed TASK_MAX_ATTEMPTS times without
+# being completed. It stays in the database, where it can be inspected and
+# reset, but isn't claimed again.
+
+TASK_MAX_ATTEMPTS = 5
+
+BATCH_UPLOAD_WORKERS = 8
+
+# Workers may wait up to TASK_LONG_POLL_MAX_WAIT seconds for new tasks. Tasks
+# created by another process are noticed within TASK_POLL_INTERVAL seconds.
+
+TASK_LONG_POLL_MAX_WAIT = 30
+
+TASK_POLL_INTERVAL = 2
+
+TASK_EVENTS_MAX_DURATION = 300
+
+# Claimed tasks are the ones with the highest priority. A task gains
+# TASK_PRIORITY_HIT_WEIGHT for each request of its image at its size, and
+# TASK_PRIORITY_AGING for each hour it was created before newer ones.
+
+TASK_PRIORITY_HIT_WEIGHT = 1.0
+
+TASK_PRIORITY_AGING = 60.0
+
+
+# Quality used by the encode_variants command for each format
+
+ENCODER_QUALITY = {"avif": 60, "webp": 80, "jpegli": 85}
+
+
+# Request statistics are kept in memory and written to the database every
+# STATS_FLUSH_INTERVAL seconds.
+
+STATS_FLUSH_INTERVAL = 10
+
+
+# Size ladder
+# Requested widths and heights are rounded up to the next entry of
+# SIZE_LADDER, or, if only SIZE_LADDER_STEP is set, to the next rung of a
+# ladder starting at SIZE_LADDER_MIN and growing by SIZE_LADDER_STEP percent.
+# Both unset serves the exact requested size.
+
+SIZE_LADDER = None
+
+SIZE_LADDER_STEP = None
+
+SIZE_LADDER_MIN = 16
+
 from .local_settings import *